@@ -1,4 +1,5 @@
 import torch
+import numpy as np
 import torchvision.models as models
 import ray
 import torchvision.models as models
@@ -8,6 +9,7 @@ import torch.nn as nn
 from torchvision import transforms
 from collections import OrderedDict
 from BMAassumptions import *
+from region_clf_runtime import predict_batch_array
 
 
 def remove_data_parallel(old_state_dict):
@@ -31,16 +33,26 @@ class ResNetModel(pl.LightningModule):
         return self.model(x)
 
 
-def load_clf_model(ckpt_path):
-    """Load the classifier model."""
+def load_clf_model(ckpt_path, device="cuda", num_threads=None):
+    """Load the classifier model.
+
+    On the CPU the weights are converted to channels_last, and num_threads (if given) sets the number of intra-op threads of the process.
+    """
 
     # To deploy a checkpoint and use for inference
     trained_model = ResNetModel.load_from_checkpoint(
-        ckpt_path
-    )  # , map_location=torch.device("cpu"))
+        ckpt_path, map_location=torch.device(device)
+    )
+
+    # move the model to the device
+    trained_model.to(device)
+
+    if torch.device(device).type == "cpu":
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
 
-    # move the model to the GPU
-    trained_model.to("cuda")
+        # oneDNN convolutions are fastest with NHWC weights and activations
+        trained_model.to(memory_format=torch.channels_last)
 
     # turn off the training mode
     trained_model.eval()
@@ -48,30 +60,20 @@ def load_clf_model(ckpt_path):
     return trained_model
 
 
-def load_clf_model_cpu(ckpt_path):
-    """Load the classifier model."""
+def load_clf_model_cpu(ckpt_path, num_threads=None):
+    """Load the classifier model on the CPU."""
 
-    # To deploy a checkpoint and use for inference
-    trained_model = ResNetModel.load_from_checkpoint(
-        ckpt_path
-    )  # , map_location=torch.device("cpu"))
+    return load_clf_model(ckpt_path, device="cpu", num_threads=num_threads)
 
-    # move the model to the CPU
-    trained_model.to("cpu")
 
-    # turn off the training mode
-    trained_model.eval()
-
-    return trained_model
-
-
-def predict_batch(pil_images, model):
+def predict_batch(pil_images, model, device="cuda"):
     """
     Predict the confidence scores for a batch of PIL images.
 
     Parameters:
     - pil_images (list of PIL.Image.Image): List of input PIL Image objects.
     - model (torch.nn.Module): Trained model.
+    - device (str): The device the model is on.
 
     Returns:
     - list of float: List of confidence scores for the class label `1` for each image.
@@ -88,8 +90,8 @@ def predict_batch(pil_images, model):
     # Transform each image and stack them into a batch
     batch = torch.stack([transform(image.convert("RGB")) for image in pil_images])
 
-    # Move the batch to the GPU
-    batch = batch.to("cuda")
+    # Move the batch to the device of the model
+    batch = batch.to(device)
 
     with torch.no_grad():  # No need to compute gradients for inference
         logits = model(batch)
@@ -151,20 +153,22 @@ class RegionClfManager:
     - ckpt_path : the path to the checkpoint of the region classification model
     - conf_thres : the confidence threshold of the region classification model
     - max_num_regions : the maximum number of regions to classify
+    - device : the device the model runs on, use RegionClfManager.options(num_gpus=0) for "cpu"
     """
 
-    def __init__(self, ckpt_path):
+    def __init__(self, ckpt_path, device="cuda", num_threads=None):
         """Initialize the RegionClfManager object."""
 
-        self.model = load_clf_model(ckpt_path)
+        self.model = load_clf_model(ckpt_path, device=device, num_threads=num_threads)
         self.ckpt_path = ckpt_path
+        self.device = device
 
     def async_predict_batch_key_dct(self, focus_regions):
         """Classify the focus region probability score."""
 
         pil_images = [focus_region.downsampled_image for focus_region in focus_regions]
 
-        adequate_confidence_scores = predict_batch(pil_images, self.model)
+        adequate_confidence_scores = predict_batch(pil_images, self.model, device=self.device)
 
         for i in range(len(pil_images)):
             focus_regions[i].adequate_confidence_score = float(
@@ -177,3 +181,11 @@ class RegionClfManager:
             processed_batch[focus_region.idx] = focus_region
 
         return processed_batch
+
+    def async_predict_batch_array(self, images, use_bf16=False):
+        """Classify a batch of uint8 [N, H, W, 3] region arrays and return their adequate confidence scores."""
+
+        # arrays from the object store are read only, torch wants to own a writable buffer
+        images = np.require(images, requirements="W")
+
+        return predict_batch_array(images, self.model, device=self.device, use_bf16=use_bf16)
@@ -7,6 +7,7 @@ from flask import (
     make_response,
 )
 from compute_heatmap import HeatMapTileMaker
+from read_heatmap import blend_overlay
 from utils import smooth_function
 from PIL import Image
 import openslide
@@ -36,11 +37,7 @@ def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
     heatmap_image = np.array(heatmap_image.convert("RGB"))
     if region.shape[2] != 3:
         raise ValueError("Region image must be in RGB format with 3 channels")
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    overlay_image_np = np.clip(overlay_image_np, 0, 1)
-    overlay_image_np = (overlay_image_np * 255).astype(np.uint8)
+    overlay_image_np = blend_overlay(region, heatmap_image, alpha=alpha)
     return Image.fromarray(overlay_image_np)
 
 
@@ -0,0 +1,363 @@
+import os
+import csv
+import glob
+import time
+import queue
+import argparse
+import threading
+from compute_heatmap import (
+    HeatMapTileMaker,
+    get_checkpoint_path,
+    load_region_clf_model,
+    save_heatmap_and_remove_checkpoint,
+)
+from read_heatmap import HEATMAP_DTYPES
+
+# the slide extensions picked up when a directory is given
+slide_extensions = [".ndpi", ".svs", ".tif", ".tiff", ".mrxs"]
+
+# the fields of every per slide record, in the order they are written
+record_fields = [
+    "slide_path",
+    "heatmap_h5_path",
+    "device",
+    "status",
+    "num_regions",
+    "num_skipped_cells",
+    "setup_seconds",
+    "score_seconds",
+    "save_seconds",
+    "total_seconds",
+    "regions_per_second",
+    "error",
+]
+
+# marks the end of the batches of one slide, or of all slides, in a batch queue
+_end_of_slide = object()
+_end_of_slides = object()
+
+
+def list_slide_paths(slides):
+    """
+    List the slides to process from a directory or a manifest file.
+
+    Parameters:
+    - slides (str): A directory of slides, or a text file with one slide path per line.
+      Lines that are empty or start with # are ignored, relative paths are relative to the manifest.
+
+    Returns:
+    - list: The slide paths, in order.
+    """
+    if os.path.isdir(slides):
+        return sorted(
+            path
+            for path in glob.glob(os.path.join(slides, "*"))
+            if os.path.splitext(path)[1].lower() in slide_extensions
+        )
+
+    slide_paths = []
+    with open(slides) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            slide_paths.append(os.path.join(os.path.dirname(slides), line))
+    return slide_paths
+
+
+def get_heatmap_h5_path(slide_path, output_dir):
+    """Return the heatmap h5 path of a slide, named like dzsave_h5_with_heatmap names it."""
+    slide_name = os.path.splitext(os.path.basename(slide_path))[0]
+    return os.path.join(output_dir, slide_name + "_heatmap.h5")
+
+
+class BatchHeatmapRunner:
+    """
+    Compute the heatmaps of many slides with one warm model per device.
+
+    Every device has a reader thread and a scoring thread. The reader takes the next slide
+    from the shared slide queue, builds its dataset and pushes its batches into a bounded
+    queue, moving on to the next slide as soon as the last batch is queued. The scoring
+    thread runs the model on those batches, so the regions of slide N+1 are read while
+    slide N is still being scored, and the model is only loaded once per device.
+
+    === Attributes ===
+    - slide_paths: the paths of the slides to process
+    - output_dir: the directory the heatmap h5 files are saved to
+    - devices: the devices to run a model on, e.g. ["cuda:0", "cuda:1"] or ["cpu"]
+    - prefetch_batches: the number of read batches each device holds before its reader waits
+    - records_path: the CSV file every per slide record is appended to, None to only keep them in memory
+    - overwrite: whether slides with an existing heatmap h5 file are processed again
+    - heatmap_tile_maker_kwargs: the keyword arguments passed on to every HeatMapTileMaker
+    - records: the per slide records of the slides processed so far
+    """
+
+    def __init__(
+        self,
+        slide_paths,
+        output_dir,
+        devices=None,
+        prefetch_batches=8,
+        records_path=None,
+        overwrite=False,
+        num_threads=None,
+        torchscript_model_path=None,
+        save_tile_pyramid=False,
+        **heatmap_tile_maker_kwargs,
+    ):
+        self.slide_paths = slide_paths
+        self.output_dir = output_dir
+        self.devices = devices if devices is not None else ["cuda"]
+        self.prefetch_batches = prefetch_batches
+        self.records_path = records_path
+        self.overwrite = overwrite
+        self.num_threads = num_threads
+        self.torchscript_model_path = torchscript_model_path
+        self.save_tile_pyramid = save_tile_pyramid
+        self.heatmap_tile_maker_kwargs = heatmap_tile_maker_kwargs
+        self.records = []
+
+        self._slide_queue = queue.Queue()
+        self._records_lock = threading.Lock()
+        # the (device, error) of every device whose model could not be loaded
+        self._model_load_errors = []
+
+    def run(self):
+        """
+        Process every slide and return the per slide records.
+
+        Returns:
+        - list: One dict per slide with the fields of record_fields.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        for slide_path in self.slide_paths:
+            heatmap_h5_path = get_heatmap_h5_path(slide_path, self.output_dir)
+            if os.path.exists(heatmap_h5_path) and not self.overwrite:
+                print(f"Skipping {slide_path}, {heatmap_h5_path} already exists")
+                continue
+            self._slide_queue.put(slide_path)
+
+        threads = [
+            threading.Thread(target=self._run_device, args=(device,))
+            for device in self.devices
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # slides are only left over when no device could load the model
+        while True:
+            try:
+                slide_path = self._slide_queue.get_nowait()
+            except queue.Empty:
+                break
+            device, error = self._model_load_errors[-1]
+            self._add_record(self._new_record(slide_path, device), error=error)
+
+        return self.records
+
+    def _run_device(self, device):
+        """Load the model on a device and score the slides its reader thread prepares."""
+        try:
+            model = load_region_clf_model(
+                device=device,
+                num_threads=self.num_threads,
+                torchscript_model_path=self.torchscript_model_path,
+            )
+        except Exception as e:
+            # the other devices take the slides, or run records them as failed
+            print(f"Failed to load the model on {device}: {e!r}")
+            with self._records_lock:
+                self._model_load_errors.append((device, e))
+            return
+
+        batch_queue = queue.Queue(maxsize=self.prefetch_batches)
+        reader = threading.Thread(
+            target=self._read_slides, args=(model, device, batch_queue), daemon=True
+        )
+        reader.start()
+
+        while True:
+            item = batch_queue.get()
+            if item is _end_of_slides:
+                break
+
+            heatmap_tile_maker, record, error, cancel_event = item
+            if error is not None:
+                self._add_record(record, error=error)
+                continue
+
+            try:
+                self._score_slide(heatmap_tile_maker, record, batch_queue, cancel_event)
+                self._add_record(record)
+            except Exception as e:
+                self._add_record(record, error=e)
+
+        reader.join()
+
+    def _read_slides(self, model, device, batch_queue):
+        """Build the dataset of every slide taken from the slide queue and queue its batches."""
+        while True:
+            try:
+                slide_path = self._slide_queue.get_nowait()
+            except queue.Empty:
+                batch_queue.put(_end_of_slides)
+                return
+
+            record = self._new_record(slide_path, device)
+            heatmap_h5_path = record["heatmap_h5_path"]
+
+            try:
+                heatmap_tile_maker = HeatMapTileMaker(
+                    slide_path=slide_path,
+                    device=device,
+                    model=model,
+                    checkpoint_path=get_checkpoint_path(heatmap_h5_path),
+                    **self.heatmap_tile_maker_kwargs,
+                )
+            except Exception as e:
+                batch_queue.put((None, record, e, None))
+                continue
+
+            record["setup_seconds"] = time.perf_counter() - record["start_time"]
+            record["num_regions"] = len(heatmap_tile_maker.dataset.level_0_coords)
+            record["num_skipped_cells"] = heatmap_tile_maker.dataset.num_skipped_cells
+            # set by the scoring thread when the slide fails, so the rest of it is not read
+            cancel_event = threading.Event()
+            batch_queue.put((heatmap_tile_maker, record, None, cancel_event))
+
+            try:
+                for batch in heatmap_tile_maker.dataloader:
+                    if cancel_event.is_set():
+                        break
+                    batch_queue.put(batch)
+            except Exception as e:
+                # the scoring thread raises the read error for this slide
+                batch_queue.put(e)
+            batch_queue.put(_end_of_slide)
+
+    def _score_slide(self, heatmap_tile_maker, record, batch_queue, cancel_event):
+        """Score the queued batches of one slide and save its heatmap."""
+
+        slide_done = False
+
+        def queued_batches():
+            nonlocal slide_done
+            while True:
+                batch = batch_queue.get()
+                if batch is _end_of_slide:
+                    slide_done = True
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+
+        score_start_time = time.perf_counter()
+        try:
+            heatmap_tile_maker.compute_heatmap(batches=queued_batches())
+        finally:
+            # on errors stop the reader and drain the batches it already queued, so it can
+            # go on with the next slide
+            if not slide_done:
+                cancel_event.set()
+            while not slide_done:
+                slide_done = batch_queue.get() is _end_of_slide
+        record["score_seconds"] = time.perf_counter() - score_start_time
+
+        save_start_time = time.perf_counter()
+        save_heatmap_and_remove_checkpoint(
+            heatmap_tile_maker,
+            record["heatmap_h5_path"],
+            save_tile_pyramid=self.save_tile_pyramid,
+        )
+        record["save_seconds"] = time.perf_counter() - save_start_time
+
+    def _new_record(self, slide_path, device):
+        """Start the per slide record of a slide processed on a device."""
+        return {
+            "slide_path": slide_path,
+            "heatmap_h5_path": get_heatmap_h5_path(slide_path, self.output_dir),
+            "device": device,
+            "start_time": time.perf_counter(),
+        }
+
+    def _add_record(self, record, error=None):
+        """Finish a per slide record, print it and append it to the records file."""
+        start_time = record.pop("start_time")
+        record["total_seconds"] = time.perf_counter() - start_time
+        record["status"] = "failed" if error is not None else "done"
+        record["error"] = "" if error is None else repr(error)
+        if error is None and record["score_seconds"] > 0:
+            record["regions_per_second"] = (
+                record["num_regions"] / record["score_seconds"]
+            )
+
+        if error is not None:
+            print(f"Failed to process {record['slide_path']}: {error!r}")
+        else:
+            print(
+                f"Processed {record['slide_path']} on {record['device']} in {record['total_seconds']:.1f}s "
+                f"({record.get('regions_per_second', 0):.0f} regions/s)"
+            )
+
+        with self._records_lock:
+            self.records.append(record)
+            if self.records_path is not None:
+                write_header = not os.path.exists(self.records_path)
+                with open(self.records_path, "a", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=record_fields)
+                    if write_header:
+                        writer.writeheader()
+                    writer.writerow(record)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the heatmaps of a directory or manifest of slides."
+    )
+    parser.add_argument(
+        "slides", help="A directory of slides, or a file with one slide path per line"
+    )
+    parser.add_argument("output_dir", help="Directory to save the heatmap h5 files to")
+    parser.add_argument("--devices", nargs="+", default=["cuda"])
+    parser.add_argument("--prefetch_batches", type=int, default=8)
+    parser.add_argument(
+        "--records_path",
+        default=None,
+        help="CSV file to append the per slide timing records to, defaults to <output_dir>/heatmap_records.csv",
+    )
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--torchscript_model_path", default=None)
+    parser.add_argument("--save_tile_pyramid", action="store_true")
+    parser.add_argument("--use_tissue_mask", action="store_true")
+    parser.add_argument("--block_size", type=int, default=None)
+    parser.add_argument("--use_bf16", action="store_true")
+    parser.add_argument("--heatmap_dtype", default="float32", choices=HEATMAP_DTYPES)
+    args = parser.parse_args()
+
+    records_path = args.records_path
+    if records_path is None:
+        records_path = os.path.join(args.output_dir, "heatmap_records.csv")
+
+    runner = BatchHeatmapRunner(
+        list_slide_paths(args.slides),
+        args.output_dir,
+        devices=args.devices,
+        prefetch_batches=args.prefetch_batches,
+        records_path=records_path,
+        overwrite=args.overwrite,
+        num_threads=args.num_threads,
+        torchscript_model_path=args.torchscript_model_path,
+        save_tile_pyramid=args.save_tile_pyramid,
+        use_tissue_mask=args.use_tissue_mask,
+        block_size=args.block_size,
+        use_bf16=args.use_bf16,
+        heatmap_dtype=args.heatmap_dtype,
+    )
+    records = runner.run()
+
+    num_failed = sum(record["status"] == "failed" for record in records)
+    print(f"Processed {len(records) - num_failed} slides, {num_failed} failed")
@@ -0,0 +1,82 @@
+import time
+import argparse
+import numpy as np
+from read_heatmap import HeatMapTileLoader, get_heatmap_tile_scores
+
+
+def loop_heatmap_tile_scores(heatmap_tile_loader, level, x, y):
+    """The per cell Python loop get_heatmap_image used before get_heatmap_tile_scores."""
+    openslide_level = 18 - level
+    heatmap_grid_size = 512 // (2 ** (openslide_level))
+
+    heatmap_overlay_score = np.zeros((512, 512))
+
+    for i in range(2 ** (openslide_level)):
+        for j in range(2 ** (openslide_level)):
+            heatmap_overlay_score[
+                j * heatmap_grid_size : (j + 1) * heatmap_grid_size,
+                i * heatmap_grid_size : (i + 1) * heatmap_grid_size,
+            ] = heatmap_tile_loader.get_heatmap_values(
+                18,
+                x * 2 ** (openslide_level) + i,
+                y * 2 ** (openslide_level) + j,
+            )
+
+    return heatmap_overlay_score
+
+
+def time_per_call(function, min_seconds):
+    """Return the mean time of one call of function, repeating it for at least min_seconds."""
+    num_calls = 0
+    start_time = time.perf_counter()
+    while True:
+        function()
+        num_calls += 1
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= min_seconds:
+            return elapsed / num_calls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the looped and vectorized heatmap tile scores at every level."
+    )
+    parser.add_argument("--grid_width", type=int, default=200)
+    parser.add_argument("--grid_height", type=int, default=100)
+    parser.add_argument("--max_openslide_level", type=int, default=9)
+    parser.add_argument("--min_seconds", type=float, default=0.5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    heatmap_tile_loader = HeatMapTileLoader(
+        np_heatmap=rng.random((args.grid_width, args.grid_height))
+    )
+    heatmap_tile_loader.compute_heatmap()
+
+    print(f"{'level':>5} {'loop (ms)':>12} {'vectorized (ms)':>16} {'speedup':>9}")
+    for openslide_level in range(args.max_openslide_level + 1):
+        level = 18 - openslide_level
+        # Pick a tile that straddles the edge of the slide so the padding is exercised
+        cells_per_tile = 2**openslide_level
+        x = (args.grid_width - 1) // cells_per_tile
+        y = (args.grid_height - 1) // cells_per_tile
+
+        looped = loop_heatmap_tile_scores(heatmap_tile_loader, level, x, y)
+        vectorized = get_heatmap_tile_scores(
+            heatmap_tile_loader.dz_heatmap_dict[18], x, y, cells_per_tile
+        )
+        assert np.array_equal(looped, vectorized), f"Mismatch at level {level}"
+
+        loop_time = time_per_call(
+            lambda: loop_heatmap_tile_scores(heatmap_tile_loader, level, x, y),
+            args.min_seconds,
+        )
+        vectorized_time = time_per_call(
+            lambda: get_heatmap_tile_scores(
+                heatmap_tile_loader.dz_heatmap_dict[18], x, y, cells_per_tile
+            ),
+            args.min_seconds,
+        )
+        print(
+            f"{level:>5} {loop_time * 1000:>12.3f} {vectorized_time * 1000:>16.3f} {loop_time / vectorized_time:>8.1f}x"
+        )
@@ -0,0 +1,64 @@
+import time
+import argparse
+import tracemalloc
+import numpy as np
+from read_heatmap import blend_overlay
+
+
+def float_blend_overlay(region, heatmap, alpha=0.5):
+    """The float32 blend the servers used before blend_overlay."""
+    region = region.astype(np.float32) / 255.0
+    heatmap = heatmap.astype(np.float32) / 255.0
+    heatmap = heatmap[: region.shape[0], : region.shape[1]]
+    overlay_image_np = (1 - alpha) * region + alpha * heatmap
+    return (np.clip(overlay_image_np, 0, 1) * 255).astype(np.uint8)
+
+
+def measure(blend_function, region, heatmap, alpha, min_seconds):
+    """Return the mean time per call and the peak traced allocation of one call."""
+    tracemalloc.start()
+    blend_function(region, heatmap, alpha)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    num_calls = 0
+    start_time = time.perf_counter()
+    while True:
+        blend_function(region, heatmap, alpha)
+        num_calls += 1
+        elapsed = time.perf_counter() - start_time
+        if elapsed >= min_seconds:
+            return elapsed / num_calls, peak_bytes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the float32 and fixed point overlay blends on one tile."
+    )
+    parser.add_argument("--tile_size", type=int, default=512)
+    parser.add_argument("--min_seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = (args.tile_size, args.tile_size, 3)
+    region = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    heatmap = rng.integers(0, 256, size=shape, dtype=np.uint8)
+
+    print(
+        f"{'alpha':>6} {'float (ms)':>11} {'fixed (ms)':>11} {'float peak (MiB)':>17} {'fixed peak (MiB)':>17} {'max diff':>9}"
+    )
+    for alpha in [0.1, 0.25, 0.5, 0.75, 0.9]:
+        max_diff = np.abs(
+            float_blend_overlay(region, heatmap, alpha).astype(np.int16)
+            - blend_overlay(region, heatmap, alpha)
+        ).max()
+
+        float_time, float_peak = measure(
+            float_blend_overlay, region, heatmap, alpha, args.min_seconds
+        )
+        fixed_time, fixed_peak = measure(
+            blend_overlay, region, heatmap, alpha, args.min_seconds
+        )
+        print(
+            f"{alpha:>6} {float_time * 1000:>11.3f} {fixed_time * 1000:>11.3f} {float_peak / 2**20:>17.2f} {fixed_peak / 2**20:>17.2f} {max_diff:>9}"
+        )
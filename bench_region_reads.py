@@ -0,0 +1,54 @@
+import time
+import argparse
+import openslide
+from torch.utils.data import DataLoader
+from dataset import LowMagRegionDataset, LowMagRegionBlockDataset, block_collate_fn
+from compute_heatmap import custom_collate_fn
+
+
+def regions_per_second(dataloader, max_regions):
+    """Iterate the dataloader until max_regions regions are read and return the read rate."""
+    num_regions = 0
+    start_time = time.perf_counter()
+    for pil_images, coordinates in dataloader:
+        num_regions += len(pil_images)
+        if num_regions >= max_regions:
+            break
+    return num_regions / (time.perf_counter() - start_time), num_regions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare per region and per block level 3 reads of LowMagRegionDataset."
+    )
+    parser.add_argument("slide_path")
+    parser.add_argument("--block_sizes", type=int, nargs="+", default=[8, 16, 32, 64])
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--max_regions", type=int, default=20000)
+    args = parser.parse_args()
+
+    slide = openslide.OpenSlide(args.slide_path)
+
+    dataset = LowMagRegionDataset(slide)
+    dataloader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        collate_fn=custom_collate_fn,
+    )
+    rate, num_regions = regions_per_second(dataloader, args.max_regions)
+    print(f"per region reads: {rate:.0f} regions/s over {num_regions} regions")
+
+    for block_size in args.block_sizes:
+        block_dataset = LowMagRegionBlockDataset(slide, block_size=block_size)
+        block_dataloader = DataLoader(
+            block_dataset,
+            batch_size=None,
+            num_workers=args.num_workers,
+            collate_fn=block_collate_fn,
+        )
+        block_rate, num_regions = regions_per_second(block_dataloader, args.max_regions)
+        print(
+            f"{block_size}x{block_size} block reads: {block_rate:.0f} regions/s over {num_regions} regions ({block_rate / rate:.1f}x)"
+        )
@@ -1,52 +1,123 @@
+import io
+import os
 import h5py
 import openslide
 import numpy as np
 from utils import smooth_function
 from PIL import Image
-from matplotlib.colors import LinearSegmentedColormap
 from tqdm import tqdm
-from dataset import LowMagRegionDataset
+from dataset import LowMagRegionDataset, LowMagRegionBlockDataset, block_collate_fn
+import torch
 from torch.utils.data import DataLoader
-from BMARegionClfManager import load_clf_model, predict_batch
+from region_clf_runtime import load_clf_model_torchscript, predict_batch_array
 from BMAassumptions import region_clf_ckpt_path
+from read_heatmap import (
+    HEATMAP_DTYPES,
+    generate_red_green_heatmap,
+    get_dz_tile_grid_shape,
+    get_dz_tile_scores,
+    get_dz_tile_size,
+    get_heatmap_overlay,
+    to_heatmap_dtype,
+    upcast_heatmap,
+)
+from heatmap_colormaps import COLORMAP_LUTS, DEFAULT_COLORMAP, quantize_scores
+from tile_h5 import create_tile_dataset, encode_tile_value
 
 batch_size = 256
 num_workers = 32
+# chunk shape of the score grid and completed bitmap in a checkpoint file
+checkpoint_chunk_shape = (64, 64)
 
 
-def generate_red_green_heatmap(matrix):
-    """
-    Generates a heatmap where values closer to 0 are red and closer to 1 are green.
+# Custom collate function to handle PIL images and names
+def custom_collate_fn(batch):
+    # Batch is a list of tuples (PIL image, image_name)
+    pil_images, coordinates = zip(*batch)
+    return list(pil_images), list(coordinates)
 
-    Parameters:
-    - matrix (numpy.ndarray): A 2D array with values between 0 and 1.
 
-    Returns:
-    - heatmap_pil (PIL.Image.Image): The heatmap image as a PIL Image object.
+# Collate function stacking uint8 region arrays into one [N, H, W, 3] tensor
+def array_collate_fn(batch):
+    # Batch is a list of tuples (uint8 array, coordinates)
+    # the coordinates become an int64 [N, 2] array of (x, y) to index the heatmap with
+    images, coordinates = zip(*batch)
+    return torch.from_numpy(np.stack(images)), np.array(coordinates, dtype=np.int64)
+
+
+class ScoreStats:
+    """
+    Summary statistics of the region scores, updated one batch at a time.
+
+    === Attributes ===
+    - num_bins: the number of equal width histogram bins over [0, 1]
+    - count: the number of scores seen
+    - total: the sum of the scores seen
+    - max_score: the largest score seen, 0 before any score
+    - histogram: the int64 count of scores in every bin, scores outside [0, 1] count towards the end bins
     """
-    # Define the custom colormap: red for 0, green for 1
-    red_green_cmap = LinearSegmentedColormap.from_list("RedGreen", ["red", "green"])
 
-    # Normalize the matrix to range [0, 1] if needed (you mentioned values are between 0 and 1)
-    normalized_matrix = np.clip(matrix, 0, 1)  # Ensure values are in [0, 1]
+    def __init__(self, num_bins=20):
+        self.num_bins = num_bins
+        self.count = 0
+        self.total = 0.0
+        self.max_score = 0.0
+        self.histogram = np.zeros(num_bins, dtype=np.int64)
 
-    # Apply the colormap to the matrix
-    heatmap_image = red_green_cmap(normalized_matrix)
+    def update(self, scores):
+        """Add a batch of scores to the statistics."""
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if scores.size == 0:
+            return
 
-    # Remove the alpha channel from the resulting image (if it exists)
-    heatmap_image = (heatmap_image[:, :, :3] * 255).astype(np.uint8)
+        self.count += scores.size
+        self.total += float(scores.sum())
+        self.max_score = max(self.max_score, float(scores.max()))
 
-    # Convert the NumPy array to a PIL Image
-    heatmap_pil = Image.fromarray(heatmap_image)
+        bins = (np.clip(scores, 0, 1) * self.num_bins).astype(np.int64)
+        np.minimum(bins, self.num_bins - 1, out=bins)
+        self.histogram += np.bincount(bins, minlength=self.num_bins)
 
-    return heatmap_pil
+    @property
+    def mean_score(self):
+        return self.total / self.count if self.count > 0 else 0.0
 
+    def to_attrs(self):
+        """
+        Return the statistics as HDF5 attributes.
 
-# Custom collate function to handle PIL images and names
-def custom_collate_fn(batch):
-    # Batch is a list of tuples (PIL image, image_name)
-    pil_images, coordinates = zip(*batch)
-    return list(pil_images), list(coordinates)
+        Returns:
+        - dict: The attribute names and values.
+        """
+        return {
+            "num_scored_cells": self.count,
+            "max_score": self.max_score,
+            "mean_score": self.mean_score,
+            "score_histogram": self.histogram,
+        }
+
+
+def load_region_clf_model(device="cuda", num_threads=None, torchscript_model_path=None):
+    """
+    Load the region classifier, from a TorchScript export if one is given.
+
+    Parameters:
+    - device (str): The device to load the model on.
+    - num_threads (int): The number of intra-op threads on CPU.
+    - torchscript_model_path (str): The path of a model exported by export_region_clf.py, None to load region_clf_ckpt_path.
+
+    Returns:
+    - torch.nn.Module: The model in eval mode.
+    """
+    if torchscript_model_path is not None:
+        return load_clf_model_torchscript(
+            torchscript_model_path, device=device, num_threads=num_threads
+        )
+
+    # pytorch_lightning and torchvision are only needed for the training checkpoint
+    from BMARegionClfManager import load_clf_model
+
+    return load_clf_model(region_clf_ckpt_path, device=device, num_threads=num_threads)
 
 
 def dyadic_average_downsample_heatmap(float_matrix):
@@ -83,6 +154,76 @@ def dyadic_average_downsample_heatmap(float_matrix):
     return downsampled_matrix
 
 
+def save_heatmap_tile_pyramid_to_h5(
+    f,
+    dz_heatmap_dict,
+    slide_width,
+    slide_height,
+    colormap=DEFAULT_COLORMAP,
+    tile_size=512,
+    jpeg_quality=90,
+):
+    """
+    Write the score pyramid and pre-rendered colored heatmap tiles to an open HDF5 file.
+
+    The scores of every DZ level go to the "pyramid" group, and the colored tiles go to
+    the level datasets "0" to "18" in the v2 tile format, laid out like the tiles of the
+    slide so the servers can read heatmap tiles the same way as slide tiles. Like the slide
+    tiles, the tiles at the right and bottom edges of a level are cropped to the level.
+
+    Parameters:
+    - f (h5py.File): The HDF5 file open for writing.
+    - dz_heatmap_dict (dict): The score pyramid, mapping DZ levels 0 to 18 to score grids.
+    - slide_width (int): The width of the slide at level 0.
+    - slide_height (int): The height of the slide at level 0.
+    - colormap (str): The name of the colormap to render the tiles with.
+    - tile_size (int): The size of the tiles in pixels.
+    - jpeg_quality (int): The JPEG quality of the tiles.
+    """
+    f.create_dataset("level_0_width", data=slide_width)
+    f.create_dataset("level_0_height", data=slide_height)
+    f.attrs["colormap"] = colormap
+
+    pyramid_group = f.create_group("pyramid")
+    for level, score_grid in dz_heatmap_dict.items():
+        pyramid_group.create_dataset(str(level), data=score_grid)
+
+    lut = COLORMAP_LUTS[colormap]
+    uniform_tile_bytes = {}  # Most tiles are a single color, encode those only once
+
+    for level in sorted(dz_heatmap_dict):
+        num_tiles_x, num_tiles_y = get_dz_tile_grid_shape(
+            slide_width, slide_height, level, tile_size
+        )
+        tile_dataset = create_tile_dataset(f, level, (num_tiles_x, num_tiles_y))
+
+        for x in tqdm(range(num_tiles_x), desc=f"Rendering heatmap level {level}"):
+            for y in range(num_tiles_y):
+                tile_width, tile_height = get_dz_tile_size(
+                    slide_width, slide_height, level, x, y, tile_size
+                )
+                # the scores are indexed as [row, col], i.e. [y, x]
+                tile_indices = quantize_scores(
+                    get_dz_tile_scores(dz_heatmap_dict, level, x, y, tile_size)
+                )[:tile_height, :tile_width]
+                color_index = int(tile_indices[0, 0])
+                is_uniform = (tile_indices == color_index).all()
+                uniform_key = (color_index, tile_indices.shape)
+
+                if is_uniform and uniform_key in uniform_tile_bytes:
+                    tile_bytes = uniform_tile_bytes[uniform_key]
+                else:
+                    buffer = io.BytesIO()
+                    Image.fromarray(lut[tile_indices]).save(
+                        buffer, format="JPEG", quality=jpeg_quality
+                    )
+                    tile_bytes = buffer.getvalue()
+                    if is_uniform:
+                        uniform_tile_bytes[uniform_key] = tile_bytes
+
+                tile_dataset[x, y] = encode_tile_value(tile_bytes)
+
+
 class HeatMapTileMaker:
     """
     === Attributes ===
@@ -91,56 +232,277 @@ class HeatMapTileMaker:
     - tile_size: the size of the tiles
     - dataset: the dataset object to extract tiles from
     - dataloader: the dataloader object to load the tiles
-    - heatmap: the heatmap of the slide stored at the highest resolution, it is a float tensor where heatmap[x, y] is the confidence score of the region at (x, y)
+    - heatmap: the heatmap of the slide stored at the highest resolution, it is a float32 array where heatmap[x, y] is the confidence score of the region at (x, y)
+    - heatmap_dtype: the dtype of the pyramid levels in dz_heatmap_dict and of the saved heatmap, one of HEATMAP_DTYPES
     - model: the classifier model to predict the heatmap
+    - background_fill_value: the score given to the regions skipped by the tissue mask
+    - block_size: the number of regions along each side of a block read at once, None to read regions one at a time
+    - device: the device the model runs on, "cuda" or "cpu"
+    - use_bf16: whether the model runs under bfloat16 autocast
+    - torchscript_model_path: the path of a model exported by export_region_clf.py, None to load region_clf_ckpt_path
+    - checkpoint_path: the path of the HDF5 file the scores are checkpointed to while computing, None to keep them only in memory
+    - checkpoint_every: the number of batches between two checkpoint writes
+    - model: the classifier model, loaded for the device unless an already loaded one is given
+    - completed: a boolean array where completed[x, y] is whether the region at (x, y) has been scored, including by a resumed run
+    - score_stats: the running statistics of the scores of the completed regions
 
     """
 
-    def __init__(self, slide_path, tile_size=512):
+    def __init__(
+        self,
+        slide_path,
+        tile_size=512,
+        use_tissue_mask=False,
+        background_fill_value=0.0,
+        block_size=None,
+        device="cuda",
+        num_threads=None,
+        use_bf16=False,
+        torchscript_model_path=None,
+        checkpoint_path=None,
+        checkpoint_every=10,
+        model=None,
+        heatmap_dtype="float32",
+    ):
+        if heatmap_dtype not in HEATMAP_DTYPES:
+            raise ValueError(
+                f"Heatmap dtype must be one of {HEATMAP_DTYPES}, got {heatmap_dtype}"
+            )
+
         self.slide_path = slide_path
         self.tile_size = tile_size
+        self.background_fill_value = background_fill_value
+        self.block_size = block_size
+        self.device = device
+        self.use_bf16 = use_bf16
+        self.heatmap_dtype = heatmap_dtype
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        # pinned host memory only speeds up copies to a GPU
+        pin_memory = device != "cpu"
         self.slide = openslide.OpenSlide(self.slide_path)
-        self.dataset = LowMagRegionDataset(self.slide, self.tile_size)
-        self.dataloader = DataLoader(
-            self.dataset,
-            batch_size=batch_size,
-            num_workers=num_workers,
-            collate_fn=custom_collate_fn,
-        )
-        # Load the model
-        self.model = load_clf_model(region_clf_ckpt_path)
 
         # shape of the heatmap should be slide_width_level_0 // 512, slide_height_level_0 // 512, we start by initializing it to zeros numpy array
-        self.heatmap = np.zeros(
-            (self.slide.dimensions[0] // 512, self.slide.dimensions[1] // 512)
+        # regions skipped as background keep the background_fill_value
+        # the scores are collected in float32, the precision the model outputs them in
+        self.heatmap = np.full(
+            (self.slide.dimensions[0] // 512, self.slide.dimensions[1] // 512),
+            self.background_fill_value,
+            dtype=np.float32,
         )
+        self.completed = np.zeros(self.heatmap.shape, dtype=bool)
+        self.score_stats = ScoreStats()
         self.dz_heatmap_dict = {}
 
-    def compute_heatmap(self):
+        # pick up the scores of a previous run that did not finish
+        if self.checkpoint_path is not None:
+            self.load_checkpoint()
+        skip_mask = self.completed if self.completed.any() else None
+
+        if block_size is None:
+            self.dataset = LowMagRegionDataset(
+                self.slide,
+                self.tile_size,
+                use_tissue_mask=use_tissue_mask,
+                as_arrays=True,
+                skip_mask=skip_mask,
+            )
+            self.dataloader = DataLoader(
+                self.dataset,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                collate_fn=array_collate_fn,
+                pin_memory=pin_memory,
+            )
+        else:
+            # every item is already a batch of the regions of one block_size x block_size block
+            self.dataset = LowMagRegionBlockDataset(
+                self.slide,
+                self.tile_size,
+                block_size=block_size,
+                use_tissue_mask=use_tissue_mask,
+                as_arrays=True,
+                skip_mask=skip_mask,
+            )
+            self.dataloader = DataLoader(
+                self.dataset,
+                batch_size=None,
+                num_workers=num_workers,
+                collate_fn=block_collate_fn,
+                pin_memory=pin_memory,
+            )
+        # Load the model, unless a warm one is passed in
+        if model is not None:
+            self.model = model
+        else:
+            self.model = load_region_clf_model(
+                device=self.device,
+                num_threads=num_threads,
+                torchscript_model_path=torchscript_model_path,
+            )
+
+    def load_checkpoint(self):
+        """
+        Load the scores and the completed bitmap of a previous run from self.checkpoint_path.
+        A checkpoint of another slide, or with another grid shape, is ignored and overwritten.
+        A checkpoint that can not be read, e.g. truncated by the crash it was meant to survive,
+        is deleted.
+        """
+        if not os.path.exists(self.checkpoint_path):
+            return
 
-        largest_score = 0
-        # Iterate through the dataset with a DataLoader and progress bar
-        for pil_images, coordinates in tqdm(self.dataloader, desc="Processing Batches"):
-            # Predict batch of images
-            scores = predict_batch(pil_images, self.model)
+        try:
+            with h5py.File(self.checkpoint_path, "r") as f:
+                if (
+                    f.attrs.get("slide_path") != self.slide_path
+                    or "completed" not in f
+                    or f["completed"].shape != self.heatmap.shape
+                ):
+                    print(
+                        f"Checkpoint {self.checkpoint_path} does not match {self.slide_path}, starting over"
+                    )
+                    return
+
+                completed = f["completed"][()].astype(bool)
+                checkpoint_heatmap = f["heatmap"][()]
+        except (OSError, KeyError) as e:
+            print(
+                f"Discarding unreadable checkpoint {self.checkpoint_path}, starting over: {e}"
+            )
+            os.remove(self.checkpoint_path)
+            return
+
+        self.completed = completed
+        self.heatmap[self.completed] = checkpoint_heatmap[self.completed]
+
+        print(
+            f"Resuming from {self.checkpoint_path}: {int(self.completed.sum())} of {self.heatmap.size} regions already scored"
+        )
 
-            for i, (x, y) in enumerate(coordinates):
-                # Update the heatmap with the confidence score, as a float
-                self.heatmap[x, y] = scores[i]
+    def open_checkpoint(self):
+        """
+        Open the checkpoint file for writing, creating the chunked score grid and completed bitmap unless resuming.
 
-                # Update the largest score if needed
-                if scores[i] > largest_score:
-                    largest_score = scores[i]
+        Returns:
+        - h5py.File: The open checkpoint file.
+        """
+        if self.completed.any():
+            return h5py.File(self.checkpoint_path, "a")
+
+        f = h5py.File(self.checkpoint_path, "w")
+        f.attrs["slide_path"] = self.slide_path
+        chunks = tuple(
+            max(1, min(chunk, size))
+            for chunk, size in zip(checkpoint_chunk_shape, self.heatmap.shape)
+        )
+        f.create_dataset("heatmap", data=self.heatmap, chunks=chunks)
+        f.create_dataset("completed", data=self.completed, chunks=chunks)
+        return f
 
-        self.dz_heatmap_dict[18] = self.heatmap
+    def write_checkpoint(self, f, x_start, x_end):
+        """
+        Write the scores and the completed bitmap of the columns x_start to x_end to the checkpoint file.
+        The regions are read column by column, so only the chunks of those columns are rewritten.
+        """
+        f["heatmap"][x_start:x_end] = self.heatmap[x_start:x_end]
+        f["completed"][x_start:x_end] = self.completed[x_start:x_end]
+        f.flush()
+
+    def score_batches(self, batches):
+        """
+        Score batches of regions with the model, yielding the scores in the order of the batches.
+
+        Parameters:
+        - batches (iterable): The (images, coordinates) batches of uint8 [N, H, W, 3] images.
+
+        Yields:
+        - tuple: The (scores, coordinates) of every batch.
+        """
+        for images, coordinates in batches:
+            # Predict batch of uint8 [N, H, W, 3] images
+            scores = predict_batch_array(
+                images, self.model, device=self.device, use_bf16=self.use_bf16
+            )
+            yield scores, coordinates
+
+    def compute_heatmap(self, batches=None):
+        """
+        Score every region of the dataset and build the heatmap pyramid.
+
+        Parameters:
+        - batches (iterable): The (images, coordinates) batches to score, defaults to iterating self.dataloader.
+        """
+        if batches is None:
+            batches = self.dataloader
+
+        # the scores loaded from a checkpoint count towards the statistics
+        self.score_stats = ScoreStats()
+        self.score_stats.update(self.heatmap[self.completed])
 
+        checkpoint_file = None
+        if self.checkpoint_path is not None:
+            checkpoint_file = self.open_checkpoint()
+        # the range of columns scored since the last checkpoint write
+        dirty_x_start, dirty_x_end = None, None
+
+        # Iterate through the dataset with a DataLoader and progress bar
+        try:
+            for batch_index, (scores, coordinates) in enumerate(
+                tqdm(
+                    self.score_batches(batches),
+                    desc="Processing Batches",
+                    total=len(self.dataloader),
+                )
+            ):
+                if len(coordinates) == 0:
+                    continue
+
+                # Update the heatmap with the confidence scores in one scatter
+                coordinates = np.asarray(coordinates, dtype=np.int64).reshape(-1, 2)
+                batch_x, batch_y = coordinates[:, 0], coordinates[:, 1]
+                self.heatmap[batch_x, batch_y] = scores
+                self.completed[batch_x, batch_y] = True
+                self.score_stats.update(scores)
+
+                if checkpoint_file is not None:
+                    if dirty_x_start is None:
+                        dirty_x_start, dirty_x_end = batch_x.min(), batch_x.max() + 1
+                    else:
+                        dirty_x_start = min(dirty_x_start, batch_x.min())
+                        dirty_x_end = max(dirty_x_end, batch_x.max() + 1)
+
+                    if (batch_index + 1) % self.checkpoint_every == 0:
+                        self.write_checkpoint(
+                            checkpoint_file, dirty_x_start, dirty_x_end
+                        )
+                        dirty_x_start, dirty_x_end = None, None
+        finally:
+            # an error or interrupt keeps the scores of the batches done so far
+            if checkpoint_file is not None:
+                try:
+                    if dirty_x_start is not None:
+                        self.write_checkpoint(
+                            checkpoint_file, dirty_x_start, dirty_x_end
+                        )
+                finally:
+                    checkpoint_file.close()
+
+        self.dz_heatmap_dict[18] = to_heatmap_dtype(self.heatmap, self.heatmap_dtype)
+
+        # the levels are averaged in float32 and stored in heatmap_dtype
         current_heatmap = self.heatmap
 
         for level in range(18 - 1, -1, -1):
             current_heatmap = dyadic_average_downsample_heatmap(current_heatmap)
-            self.dz_heatmap_dict[level] = current_heatmap
-
-        print(f"Largest score: {largest_score}")
+            self.dz_heatmap_dict[level] = to_heatmap_dtype(
+                current_heatmap, self.heatmap_dtype
+            )
+
+        print(f"Largest score: {self.score_stats.max_score}")
+        print(f"Mean score: {self.score_stats.mean_score}")
+        print(
+            f"Skipped {self.dataset.num_skipped_cells} of {self.heatmap.size} regions as background"
+        )
 
     def get_heatmap_values(self, level, x, y):
         """
@@ -157,7 +519,7 @@ class HeatMapTileMaker:
 
         try:
             return float(
-                self.dz_heatmap_dict[level][x, y]
+                upcast_heatmap(self.dz_heatmap_dict[level][x, y])
             )  # if index out of bounds, return 0
         except IndexError:
             return float(0)
@@ -188,38 +550,93 @@ class HeatMapTileMaker:
         - np.ndarray: The heatmap overlay as a NumPy array.
         """
 
-        openslide_level = 18 - level
-        heatmap_grid_size = 512 // (2 ** (openslide_level))
-
-        heatmap_overlay_score = np.zeros((512, 512))
-
-        for i in range(2 ** (openslide_level)):
-            for j in range(2 ** (openslide_level)):
-                # heatmap_overlay_score[j*heatmap_grid_size:(j+1)*heatmap_grid_size, i*heatmap_grid_size:(i+1)*heatmap_grid_size] = self.get_gaussian_heatmap_values(x*(2**(openslide_level)) + i, y*(2**(openslide_level)) + j)
-                heatmap_overlay_score[
-                    j * heatmap_grid_size : (j + 1) * heatmap_grid_size,
-                    i * heatmap_grid_size : (i + 1) * heatmap_grid_size,
-                ] = self.get_heatmap_values(
-                    18,
-                    x * 2 ** (openslide_level) + i,
-                    y * 2 ** (openslide_level) + j,
-                )
+        heatmap_overlay_score = get_dz_tile_scores(self.dz_heatmap_dict, level, x, y)
 
         return generate_red_green_heatmap(heatmap_overlay_score)
 
-    def save_heatmap_to_h5(self, heatmap_h5_save_path):
+    def save_heatmap_to_h5(self, heatmap_h5_save_path, save_tile_pyramid=False):
         # save the self.dz_heatmap_dict[18] to the h5 file with a key "heatmap"
+        # optionally along with the score pyramid and the rendered heatmap tiles
 
         with h5py.File(heatmap_h5_save_path, "w") as f:
             f.create_dataset("heatmap", data=self.dz_heatmap_dict[18])
+            f.attrs["num_skipped_cells"] = self.dataset.num_skipped_cells
+            f.attrs.update(self.score_stats.to_attrs())
+
+            if save_tile_pyramid:
+                save_heatmap_tile_pyramid_to_h5(
+                    f,
+                    self.dz_heatmap_dict,
+                    self.slide.dimensions[0],
+                    self.slide.dimensions[1],
+                    tile_size=self.tile_size,
+                )
 
         print(f"Saved heatmap to {heatmap_h5_save_path}")
 
 
-def create_heatmap_to_h5(slide_path, heatmap_h5_save_path):
-    heatmap_tile_maker = HeatMapTileMaker(slide_path=slide_path, tile_size=512)
+def get_checkpoint_path(heatmap_h5_save_path):
+    """Return the path the scores of a heatmap are checkpointed to, next to the output, while computing."""
+    return heatmap_h5_save_path + ".partial"
+
+
+def save_heatmap_and_remove_checkpoint(
+    heatmap_tile_maker, heatmap_h5_save_path, save_tile_pyramid=False
+):
+    """
+    Save a computed heatmap to h5 and remove its checkpoint, which is no longer needed.
+
+    Parameters:
+    - heatmap_tile_maker (HeatMapTileMaker): The tile maker the heatmap was computed with.
+    - heatmap_h5_save_path (str): The path to save the heatmap h5 file to.
+    - save_tile_pyramid (bool): Whether to also save the score pyramid and the rendered heatmap tiles.
+    """
+    heatmap_tile_maker.save_heatmap_to_h5(
+        heatmap_h5_save_path, save_tile_pyramid=save_tile_pyramid
+    )
+
+    checkpoint_path = heatmap_tile_maker.checkpoint_path
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def create_heatmap_to_h5(
+    slide_path,
+    heatmap_h5_save_path,
+    save_tile_pyramid=False,
+    use_tissue_mask=False,
+    background_fill_value=0.0,
+    block_size=None,
+    device="cuda",
+    num_threads=None,
+    use_bf16=False,
+    torchscript_model_path=None,
+    resume=True,
+    heatmap_dtype="float32",
+    heatmap_tile_maker_class=HeatMapTileMaker,
+    **heatmap_tile_maker_kwargs,
+):
+    # the scores are checkpointed next to the output, a rerun after a crash picks up from there
+    checkpoint_path = get_checkpoint_path(heatmap_h5_save_path) if resume else None
+
+    heatmap_tile_maker = heatmap_tile_maker_class(
+        slide_path=slide_path,
+        tile_size=512,
+        use_tissue_mask=use_tissue_mask,
+        background_fill_value=background_fill_value,
+        block_size=block_size,
+        device=device,
+        num_threads=num_threads,
+        use_bf16=use_bf16,
+        torchscript_model_path=torchscript_model_path,
+        checkpoint_path=checkpoint_path,
+        heatmap_dtype=heatmap_dtype,
+        **heatmap_tile_maker_kwargs,
+    )
     heatmap_tile_maker.compute_heatmap()
-    heatmap_tile_maker.save_heatmap_to_h5(heatmap_h5_save_path)
+    save_heatmap_and_remove_checkpoint(
+        heatmap_tile_maker, heatmap_h5_save_path, save_tile_pyramid=save_tile_pyramid
+    )
 
 
 class HeatMapTileLoader:
@@ -236,11 +653,16 @@ class HeatMapTileLoader:
         largest_score = 0
         self.dz_heatmap_dict[18] = self.heatmap
 
-        current_heatmap = self.heatmap
+        # the levels are averaged in float and stored in the dtype of the heatmap, e.g.
+        # a uint8 heatmap is averaged as scores and not as raw 0 to 255 values
+        heatmap_dtype = self.heatmap.dtype.name
+        current_heatmap = upcast_heatmap(self.heatmap)
 
         for level in range(18 - 1, -1, -1):
             current_heatmap = dyadic_average_downsample_heatmap(current_heatmap)
-            self.dz_heatmap_dict[level] = current_heatmap
+            self.dz_heatmap_dict[level] = to_heatmap_dtype(
+                current_heatmap, heatmap_dtype
+            )
 
         print(f"Largest score: {largest_score}")
 
@@ -259,7 +681,7 @@ class HeatMapTileLoader:
 
         try:
             return float(
-                self.dz_heatmap_dict[level][x, y]
+                upcast_heatmap(self.dz_heatmap_dict[level][x, y])
             )  # if index out of bounds, return 0
         except IndexError:
             return float(0)
@@ -277,22 +699,7 @@ class HeatMapTileLoader:
         - np.ndarray: The heatmap overlay as a NumPy array.
         """
 
-        openslide_level = 18 - level
-        heatmap_grid_size = 512 // (2 ** (openslide_level))
-
-        heatmap_overlay_score = np.zeros((512, 512))
-
-        for i in range(2 ** (openslide_level)):
-            for j in range(2 ** (openslide_level)):
-                # heatmap_overlay_score[j*heatmap_grid_size:(j+1)*heatmap_grid_size, i*heatmap_grid_size:(i+1)*heatmap_grid_size] = self.get_gaussian_heatmap_values(x*(2**(openslide_level)) + i, y*(2**(openslide_level)) + j)
-                heatmap_overlay_score[
-                    j * heatmap_grid_size : (j + 1) * heatmap_grid_size,
-                    i * heatmap_grid_size : (i + 1) * heatmap_grid_size,
-                ] = self.get_heatmap_values(
-                    18,
-                    x * 2 ** (openslide_level) + i,
-                    y * 2 ** (openslide_level) + j,
-                )
+        heatmap_overlay_score = get_dz_tile_scores(self.dz_heatmap_dict, level, x, y)
 
         return generate_red_green_heatmap(heatmap_overlay_score)
 
@@ -305,18 +712,6 @@ class HeatMapTileLoader:
         print(f"Saved heatmap to {heatmap_h5_save_path}")
 
 
-def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
-    heatmap_image = np.array(heatmap_image.convert("RGB"))
-    if region.shape[2] != 3:
-        raise ValueError("Region image must be in RGB format with 3 channels")
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    overlay_image_np = np.clip(overlay_image_np, 0, 1)
-    overlay_image_np = (overlay_image_np * 255).astype(np.uint8)
-    return Image.fromarray(overlay_image_np)
-
-
 if __name__ == "__main__":
     slide_path = (
         "/media/hdd3/neo/tmp_slide_dir/H19-5749;S10;MSKI - 2023-05-24 21.38.53.ndpi"
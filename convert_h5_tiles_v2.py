@@ -0,0 +1,97 @@
+import os
+import shutil
+import argparse
+import h5py
+from tqdm import tqdm
+from tile_h5 import (
+    TILE_FORMAT_V2,
+    create_tile_dataset,
+    decode_tile_value,
+    encode_tile_value,
+    get_tile_format_version,
+    is_level_key,
+)
+
+
+def convert_h5_tiles_to_v2(h5_path, output_path=None):
+    """
+    Rewrite a v1 (base64 string) tile pyramid HDF5 file in the v2 (raw bytes) layout.
+
+    The tiles are streamed one row at a time, so memory use does not grow with the
+    slide. Without an output_path the file is converted in place, by writing to a
+    temporary file next to it and renaming it over the original once complete.
+
+    Parameters:
+    - h5_path (str): The path of the v1 HDF5 file.
+    - output_path (str): The path of the v2 HDF5 file, defaults to h5_path.
+
+    Returns:
+    - str: The path of the v2 HDF5 file.
+    """
+    in_place = output_path is None or os.path.abspath(output_path) == os.path.abspath(
+        h5_path
+    )
+    write_path = h5_path + ".v2.tmp" if in_place else output_path
+
+    with h5py.File(h5_path, "r") as src:
+        already_v2 = get_tile_format_version(src) == TILE_FORMAT_V2
+
+    if already_v2:
+        print(f"{h5_path} is already in the v2 tile format")
+        if in_place:
+            return h5_path
+        shutil.copyfile(h5_path, output_path)
+        return output_path
+
+    with h5py.File(h5_path, "r") as src:
+        try:
+            with h5py.File(write_path, "w") as dst:
+                dst.attrs.update(src.attrs)
+
+                for key in src.keys():
+                    if not is_level_key(key):
+                        src.copy(key, dst)
+                        continue
+
+                    src_dataset = src[key]
+                    num_rows, num_cols = src_dataset.shape
+                    dst_dataset = create_tile_dataset(dst, key, (num_rows, num_cols))
+
+                    for row in tqdm(range(num_rows), desc=f"Converting level {key}"):
+                        row_values = src_dataset[row, :]
+                        for col in range(num_cols):
+                            dst_dataset[row, col] = encode_tile_value(
+                                decode_tile_value(row_values[col])
+                            )
+        except Exception as e:
+            print(f"Error converting {h5_path}: {e}. Removing partial output ...")
+            if os.path.exists(write_path):
+                os.remove(write_path)
+            raise e
+
+    if in_place:
+        os.replace(write_path, h5_path)
+        write_path = h5_path
+
+    print(f"Converted {h5_path} to the v2 tile format at {write_path}")
+    return write_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert base64 tile pyramid HDF5 files to the raw bytes (v2) layout."
+    )
+    parser.add_argument("h5_paths", nargs="+", help="v1 tile pyramid HDF5 files")
+    parser.add_argument(
+        "--output_dir",
+        default=None,
+        help="Directory to write the v2 files to, the files are converted in place if omitted",
+    )
+    args = parser.parse_args()
+
+    for h5_path in args.h5_paths:
+        output_path = None
+        if args.output_dir is not None:
+            os.makedirs(args.output_dir, exist_ok=True)
+            output_path = os.path.join(args.output_dir, os.path.basename(h5_path))
+        convert_h5_tiles_to_v2(h5_path, output_path)
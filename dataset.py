@@ -1,6 +1,8 @@
 import os 
 import torch
 import openslide    
+import numpy as np
+from PIL import Image
 from torch.utils.data import Dataset, DataLoader
 
 class LowMagRegionDataset(Dataset):
@@ -10,19 +12,59 @@ class LowMagRegionDataset(Dataset):
     level_3_coords: the coordinates of all the level 3 regions
     tile_size: the size of the tiles
     tile_size_level_3: the size of the tiles at level 3
+    tissue_mask: a boolean array where tissue_mask[x, y] is whether the region at (x, y) contains tissue, None if every region is kept
+    num_skipped_cells: the number of regions skipped as background
+    skip_mask: a boolean array where skip_mask[x, y] is whether the region at (x, y) is already scored and left out, None if no region is left out
+    as_arrays: whether regions are returned as uint8 [H, W, 3] numpy arrays instead of PIL images
     """
 
-    def __init__(self, slide, tile_size=512):
+    def __init__(self, slide, tile_size=512, use_tissue_mask=False, background_threshold=220, min_tissue_fraction=0.0, as_arrays=False, skip_mask=None):
         self.tile_size = tile_size
         self.tile_size_level_3 = tile_size // 8
         self.slide = slide
+        self.as_arrays = as_arrays
+        self.skip_mask = skip_mask
 
         # Get the dimensions of the slide at level 0
         self.slide_width = self.slide.dimensions[0]
         self.slide_height = self.slide.dimensions[1]
 
+        # Mark the regions that are mostly glass so they can be skipped
+        self.tissue_mask = None
+        if use_tissue_mask:
+            self.tissue_mask = self.compute_tissue_mask(background_threshold, min_tissue_fraction)
+
         # Get the coordinates of all the level 3 regions
         self.level_0_coords = self.get_level_0_coords()
+        self.num_skipped_cells = 0 if self.tissue_mask is None else int((~self.tissue_mask).sum())
+
+    def compute_tissue_mask(self, background_threshold=220, min_tissue_fraction=0.0):
+        """
+        Compute which regions contain tissue from a low resolution level of the slide.
+        A thumbnail pixel is tissue if its darkest channel is below background_threshold, and a region is kept if more than min_tissue_fraction of its thumbnail pixels are tissue.
+        """
+        grid_width = self.slide_width // self.tile_size
+        grid_height = self.slide_height // self.tile_size
+
+        # Read the whole slide at a level with about 8x8 pixels per region
+        thumbnail_level = self.slide.get_best_level_for_downsample(self.tile_size / 8)
+        downsample = self.slide.level_downsamples[thumbnail_level]
+        thumbnail = self.slide.read_region((0, 0), thumbnail_level, self.slide.level_dimensions[thumbnail_level])
+        thumbnail = np.asarray(thumbnail.convert("RGB"))
+        tissue_pixels = thumbnail.min(axis=2) < background_threshold
+
+        # Find the region every thumbnail pixel falls in, dropping the partial regions at the edges
+        region_x = (np.arange(thumbnail.shape[1]) * downsample // self.tile_size).astype(np.int64)
+        region_y = (np.arange(thumbnail.shape[0]) * downsample // self.tile_size).astype(np.int64)
+        in_grid = (region_y[:, None] < grid_height) & (region_x[None, :] < grid_width)
+        region_index = (region_x[None, :] * grid_height + region_y[:, None])[in_grid]
+
+        # Fraction of tissue pixels per region, indexed [x, y] like the heatmap
+        num_pixels = np.bincount(region_index, minlength=grid_width * grid_height)
+        num_tissue_pixels = np.bincount(region_index, weights=tissue_pixels[in_grid], minlength=grid_width * grid_height)
+        tissue_fraction = num_tissue_pixels / np.maximum(num_pixels, 1)
+
+        return (tissue_fraction > min_tissue_fraction).reshape(grid_width, grid_height)
 
     def get_level_0_coords(self):
         """
@@ -31,6 +73,10 @@ class LowMagRegionDataset(Dataset):
         level_0_coords = []
         for x in range(self.slide_width // self.tile_size):
             for y in range(self.slide_height // self.tile_size):
+                if self.tissue_mask is not None and not self.tissue_mask[x, y]:
+                    continue
+                if self.skip_mask is not None and self.skip_mask[x, y]:
+                    continue
                 level_0_coords.append((x, y))
 
         return level_0_coords
@@ -43,4 +89,66 @@ class LowMagRegionDataset(Dataset):
         region = self.slide.read_region(location=(x * self.tile_size, y * self.tile_size), level=3, size=(self.tile_size_level_3, self.tile_size_level_3))
         region = region.convert("RGB")
         # region = torch.tensor(region).permute(2, 0, 1).float() / 255.0
-        return region, (x, y)
\ No newline at end of file
+        if self.as_arrays:
+            region = np.asarray(region)
+        return region, (x, y)
+
+class LowMagRegionBlockDataset(LowMagRegionDataset):
+    """
+    A LowMagRegionDataset where every item is a whole batch of regions cut from one block read.
+    Each item reads a block_size x block_size block of regions with a single read_region call at level 3 and slices it into the regions in NumPy, so use it with DataLoader(batch_size=None, collate_fn=block_collate_fn).
+
+    === Attributes ===
+    block_size: the number of regions along each side of a block
+    blocks: the (block_x, block_y, level_0_coords) of every block with at least one region to score
+    """
+
+    def __init__(self, slide, tile_size=512, block_size=16, **kwargs):
+        super().__init__(slide, tile_size, **kwargs)
+        self.block_size = block_size
+        self.blocks = self.get_blocks()
+
+    def get_blocks(self):
+        """
+        Group the region coordinates by the block they fall in
+        """
+        block_coords = {}
+        for x, y in self.level_0_coords:
+            block_coords.setdefault((x // self.block_size, y // self.block_size), []).append((x, y))
+
+        return [(block_x, block_y, coords) for (block_x, block_y), coords in block_coords.items()]
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        block_x, block_y, coords = self.blocks[idx]
+        x_start = block_x * self.block_size
+        y_start = block_y * self.block_size
+
+        # Only read as far as the last region of the block to score
+        num_regions_x = max(x for x, _ in coords) - x_start + 1
+        num_regions_y = max(y for _, y in coords) - y_start + 1
+        block = self.slide.read_region(location=(x_start * self.tile_size, y_start * self.tile_size), level=3, size=(num_regions_x * self.tile_size_level_3, num_regions_y * self.tile_size_level_3))
+        block = np.asarray(block.convert("RGB"))
+
+        regions = []
+        for x, y in coords:
+            row = (y - y_start) * self.tile_size_level_3
+            col = (x - x_start) * self.tile_size_level_3
+            regions.append(block[row:row + self.tile_size_level_3, col:col + self.tile_size_level_3])
+
+        if self.as_arrays:
+            return np.stack(regions), coords
+
+        return [Image.fromarray(region) for region in regions], coords
+
+
+def block_collate_fn(block):
+    # Every item of a LowMagRegionBlockDataset is already a batch of (PIL images or a uint8 [N, H, W, 3] array, coordinates)
+    # The array batches come with their coordinates as an int64 [N, 2] array of (x, y)
+    regions, coords = block
+    if isinstance(regions, np.ndarray):
+        regions = torch.from_numpy(regions)
+        coords = np.array(coords, dtype=np.int64).reshape(-1, 2)
+    return regions, coords
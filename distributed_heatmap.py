@@ -0,0 +1,185 @@
+import argparse
+import ray
+from BMAassumptions import region_clf_ckpt_path
+from BMARegionClfManager import RegionClfManager
+from compute_heatmap import HeatMapTileMaker, create_heatmap_to_h5
+from read_heatmap import HEATMAP_DTYPES
+
+
+def create_region_clf_actors(
+    num_actors, device="cuda", num_threads=None, ckpt_path=region_clf_ckpt_path
+):
+    """
+    Start a pool of RegionClfManager actors, initializing a local Ray cluster if needed.
+
+    Parameters:
+    - num_actors (int): The number of actors to start.
+    - device (str): "cuda" for one GPU per actor, or "cpu" for CPU actors.
+    - num_threads (int): The number of intra-op threads (and Ray CPUs) of each CPU actor.
+    - ckpt_path (str): The checkpoint of the region classifier.
+
+    Returns:
+    - list: The RegionClfManager actor handles.
+    """
+    if not ray.is_initialized():
+        ray.init(ignore_reinit_error=True)
+
+    if device == "cpu":
+        actor_class = RegionClfManager.options(num_gpus=0, num_cpus=num_threads or 1)
+    else:
+        actor_class = RegionClfManager
+
+    return [
+        actor_class.remote(ckpt_path, device=device, num_threads=num_threads)
+        for _ in range(num_actors)
+    ]
+
+
+class DistributedHeatMapTileMaker(HeatMapTileMaker):
+    """
+    A HeatMapTileMaker that shards the region batches across a pool of RegionClfManager actors.
+
+    The batches are read locally by the DataLoader and sent to the actor with the fewest
+    batches in flight. At most max_batches_in_flight batches are submitted or waiting to be
+    assembled at any time, so a slow actor holds the reader back instead of the batches
+    piling up in the object store. The scores are assembled into the heatmap in the order
+    the batches were read, so checkpoints always cover a prefix of the slide.
+
+    === Attributes ===
+    - actors: the RegionClfManager actor handles the batches are scored on
+    - max_batches_in_flight: the number of batches submitted or waiting to be assembled before reading waits
+    - model: the actors, the model itself only lives in the actors
+    """
+
+    def __init__(
+        self,
+        slide_path,
+        actors=None,
+        num_actors=2,
+        device="cuda",
+        num_threads=None,
+        max_batches_in_flight_per_actor=2,
+        **kwargs,
+    ):
+        if actors is None:
+            actors = create_region_clf_actors(
+                num_actors, device=device, num_threads=num_threads
+            )
+        self.actors = actors
+        self.max_batches_in_flight = max_batches_in_flight_per_actor * len(actors)
+
+        super().__init__(slide_path, device=device, model=actors, **kwargs)
+
+    def score_batches(self, batches):
+        """
+        Score batches of regions on the actors, yielding the scores in the order of the batches.
+
+        Parameters:
+        - batches (iterable): The (images, coordinates) batches of uint8 [N, H, W, 3] images.
+
+        Yields:
+        - tuple: The (scores, coordinates) of every batch.
+        """
+        # the batch index and actor index of every submitted batch that is not back yet, by object ref
+        pending = {}
+        num_in_flight = {actor_index: 0 for actor_index in range(len(self.actors))}
+        # the results that are back but wait for an earlier batch, by batch index
+        finished = {}
+        coordinates_by_index = {}
+        next_index = 0
+        num_submitted = 0
+
+        def collect_one():
+            ready, _ = ray.wait(list(pending), num_returns=1)
+            batch_index, actor_index = pending.pop(ready[0])
+            num_in_flight[actor_index] -= 1
+            finished[batch_index] = ray.get(ready[0])
+
+        for images, coordinates in batches:
+            # backpressure, wait for a batch to come back and be assembled first
+            while num_submitted - next_index >= self.max_batches_in_flight:
+                collect_one()
+                while next_index in finished:
+                    yield finished.pop(next_index), coordinates_by_index.pop(next_index)
+                    next_index += 1
+
+            actor_index = min(num_in_flight, key=num_in_flight.get)
+            ref = self.actors[actor_index].async_predict_batch_array.remote(
+                images.numpy(), use_bf16=self.use_bf16
+            )
+            pending[ref] = (num_submitted, actor_index)
+            num_in_flight[actor_index] += 1
+            coordinates_by_index[num_submitted] = coordinates
+            num_submitted += 1
+
+        while next_index < num_submitted:
+            if next_index not in finished:
+                collect_one()
+                continue
+            yield finished.pop(next_index), coordinates_by_index.pop(next_index)
+            next_index += 1
+
+
+def create_heatmap_to_h5_distributed(
+    slide_path,
+    heatmap_h5_save_path,
+    num_actors=2,
+    device="cuda",
+    num_threads=None,
+    max_batches_in_flight_per_actor=2,
+    save_tile_pyramid=False,
+    use_tissue_mask=False,
+    background_fill_value=0.0,
+    block_size=None,
+    use_bf16=False,
+    resume=True,
+    heatmap_dtype="float32",
+):
+    create_heatmap_to_h5(
+        slide_path,
+        heatmap_h5_save_path,
+        save_tile_pyramid=save_tile_pyramid,
+        use_tissue_mask=use_tissue_mask,
+        background_fill_value=background_fill_value,
+        block_size=block_size,
+        device=device,
+        num_threads=num_threads,
+        use_bf16=use_bf16,
+        resume=resume,
+        heatmap_dtype=heatmap_dtype,
+        heatmap_tile_maker_class=DistributedHeatMapTileMaker,
+        num_actors=num_actors,
+        max_batches_in_flight_per_actor=max_batches_in_flight_per_actor,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the heatmap of a slide on a pool of Ray region classifier actors."
+    )
+    parser.add_argument("slide_path")
+    parser.add_argument("heatmap_h5_save_path")
+    parser.add_argument("--num_actors", type=int, default=2)
+    parser.add_argument("--device", default="cuda", choices=["cuda", "cpu"])
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--max_batches_in_flight_per_actor", type=int, default=2)
+    parser.add_argument("--save_tile_pyramid", action="store_true")
+    parser.add_argument("--use_tissue_mask", action="store_true")
+    parser.add_argument("--block_size", type=int, default=None)
+    parser.add_argument("--use_bf16", action="store_true")
+    parser.add_argument("--heatmap_dtype", default="float32", choices=HEATMAP_DTYPES)
+    args = parser.parse_args()
+
+    create_heatmap_to_h5_distributed(
+        args.slide_path,
+        args.heatmap_h5_save_path,
+        num_actors=args.num_actors,
+        device=args.device,
+        num_threads=args.num_threads,
+        max_batches_in_flight_per_actor=args.max_batches_in_flight_per_actor,
+        save_tile_pyramid=args.save_tile_pyramid,
+        use_tissue_mask=args.use_tissue_mask,
+        block_size=args.block_size,
+        use_bf16=args.use_bf16,
+        heatmap_dtype=args.heatmap_dtype,
+    )
@@ -2,6 +2,8 @@ import os
 import shutil
 from LLRunner.slide_processing.dzsave_h5 import dzsave_h5
 from compute_heatmap import create_heatmap_to_h5
+from convert_h5_tiles_v2 import convert_h5_tiles_to_v2
+from heatmap_sidecar import export_heatmap_sidecar, get_heatmap_sidecar_path
 from tqdm import tqdm
 
 tmp_save_dir_path = "/media/hdd3/neo/tmp_heatmap_dir"
@@ -26,6 +28,8 @@ def dzsave_h5_with_heatmap(slide_path):
     heatmap_S3_save_path = os.path.join(
         S3_mount_point_heatmap_path, heatmap_h5_save_name
     )
+    heatmap_sidecar_save_path = get_heatmap_sidecar_path(heatmap_h5_save_path)
+    heatmap_sidecar_S3_save_path = get_heatmap_sidecar_path(heatmap_S3_save_path)
 
     # Generate DZI files with a spinner
     print("Generating DZI files...")
@@ -37,8 +41,16 @@ def dzsave_h5_with_heatmap(slide_path):
         region_cropping_batch_size=256,
     )
 
+    # dzsave_h5 writes base64 tiles, store them as raw bytes before uploading
+    print("Converting tiles to the v2 format...")
+    convert_h5_tiles_to_v2(tmp_save_path)
+
     print("Creating heatmap...")
-    create_heatmap_to_h5(slide_path, heatmap_h5_save_path)
+    create_heatmap_to_h5(slide_path, heatmap_h5_save_path, save_tile_pyramid=True)
+
+    # the servers memory map the score pyramid from this sidecar
+    print("Exporting heatmap sidecar...")
+    export_heatmap_sidecar(heatmap_h5_save_path, heatmap_sidecar_save_path)
 
     print(
         f"H5 file and heatmap created successfully to {tmp_save_path} and {heatmap_h5_save_path}"
@@ -49,6 +61,8 @@ def dzsave_h5_with_heatmap(slide_path):
         # Move files to the S3 mount point
         shutil.move(tmp_save_path, S3_save_path)
         shutil.move(heatmap_h5_save_path, heatmap_S3_save_path)
+        # moved after the heatmap so the sidecar is not older than it
+        shutil.move(heatmap_sidecar_save_path, heatmap_sidecar_S3_save_path)
     except Exception as e:
         print(
             f"Error uploading H5 files to S3: {e}. Cleaning up files before shutdown to prevent corruption ..."
@@ -62,6 +76,10 @@ def dzsave_h5_with_heatmap(slide_path):
             os.remove(S3_save_path)
         if os.path.exists(heatmap_S3_save_path):
             os.remove(heatmap_S3_save_path)
+        if os.path.exists(heatmap_sidecar_save_path):
+            os.remove(heatmap_sidecar_save_path)
+        if os.path.exists(heatmap_sidecar_S3_save_path):
+            os.remove(heatmap_sidecar_S3_save_path)
         print("Files cleaned up successfully.")
         raise e
 
@@ -0,0 +1,69 @@
+import argparse
+import torch
+import torch.nn as nn
+import torchvision.models as models
+from BMAassumptions import region_clf_ckpt_path
+
+
+def load_clf_state_dict_model(ckpt_path):
+    """
+    Rebuild the region classifier from the weights of a Lightning checkpoint.
+
+    The ResNet-50 is built without pretrained weights since the checkpoint overwrites all
+    of them, so no ImageNet download is needed.
+    """
+    checkpoint = torch.load(ckpt_path, map_location="cpu", weights_only=False)
+
+    # ResNetModel stores the torchvision model as self.model
+    state_dict = {
+        key[len("model.") :]: value
+        for key, value in checkpoint["state_dict"].items()
+        if key.startswith("model.")
+    }
+
+    model = models.resnet50(weights=None)
+    model.fc = nn.Linear(model.fc.in_features, state_dict["fc.weight"].shape[0])
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    return model
+
+
+def export_clf_model_torchscript(ckpt_path, output_path):
+    """
+    Freeze the region classifier checkpoint into a TorchScript model.
+
+    Parameters:
+    - ckpt_path (str): The path of the Lightning checkpoint.
+    - output_path (str): The path to save the TorchScript model to.
+    """
+    model = load_clf_state_dict_model(ckpt_path)
+    scripted_model = torch.jit.freeze(torch.jit.script(model))
+
+    # Check the frozen model against the eager model before saving it
+    example_batch = torch.rand(4, 3, 64, 64)
+    with torch.inference_mode():
+        max_difference = (
+            (scripted_model(example_batch) - model(example_batch)).abs().max()
+        )
+    print(
+        f"Max logit difference between the checkpoint and TorchScript: {max_difference}"
+    )
+
+    scripted_model.save(output_path)
+    print(f"Saved TorchScript region classifier to {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the region classifier checkpoint to TorchScript for load_clf_model_torchscript."
+    )
+    parser.add_argument("--ckpt_path", default=region_clf_ckpt_path)
+    parser.add_argument("--output_path", default=None)
+    args = parser.parse_args()
+
+    output_path = args.output_path
+    if output_path is None:
+        output_path = args.ckpt_path.replace(".ckpt", "") + "_torchscript.pt"
+
+    export_clf_model_torchscript(args.ckpt_path, output_path)
@@ -1,17 +1,36 @@
 import os
-import h5py
 import io
+import hashlib
+import struct
 import numpy as np
 import glob
-import base64
 import threading
 import time
 import boto3
 import pandas as pd
-from flask import Flask, send_file, request, jsonify, make_response
+from flask import (
+    Flask,
+    Response,
+    send_file,
+    request,
+    jsonify,
+    make_response,
+    stream_with_context,
+)
 from flask_cors import CORS
 from dotenv import load_dotenv
 from PIL import Image
+from tile_h5 import read_many_tile_bytes, read_tile_bytes
+from h5_handle_pool import h5_handle_pool
+from tile_cache import TileCache
+from tile_prefetcher import TilePrefetcher
+from heatmap_colormaps import COLORMAP_LUTS, DEFAULT_COLORMAP, apply_colormap
+from read_heatmap import (
+    blend_overlay,
+    encode_palettized_heatmap_tile,
+    get_dz_tile_scores,
+    get_dz_tile_size,
+)
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allows requests from any origin
@@ -25,16 +44,35 @@ metadata = pd.read_csv(METADATA_PATH)
 TILE_SIZE = 256
 DEFAULT_ALPHA = 0.5
 INACTIVITY_TIMEOUT = 1800  # Time in seconds before shutdown
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+HEATMAP_COLORMAP = DEFAULT_COLORMAP  # Colormap the heatmap tile pyramids are rendered with
+HEATMAP_TILE_SIZE = 512  # Size of the tiles the heatmap score pyramids are cut into
+ALPHA_STEPS = 10  # Alpha query parameters are rounded to multiples of 1 / ALPHA_STEPS
+MAX_BATCH_TILES = 256  # Maximum number of tiles in one /tiles/batch request
+MAX_TILE_LEVEL = 18  # The full resolution deep zoom level
+# Every tile of a /tiles/batch response is preceded by its level, x, y and byte length
+BATCH_TILE_HEADER = struct.Struct(">IIII")
 
 # Load environment variables from .env file
 load_dotenv()
 INSTANCE_ID = os.getenv("INSTANCE_ID")
 AWS_REGION = os.getenv("AWS_REGION")
+TILE_CACHE_MAX_BYTES = int(
+    os.getenv("TILE_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+)  # Memory budget of the overlay tile cache
+TILE_PREFETCH_WORKERS = int(
+    os.getenv("TILE_PREFETCH_WORKERS", 2)
+)  # Threads warming the tile cache around requested tiles, 0 to disable prefetching
+TILE_MAX_AGE = int(
+    os.getenv("TILE_MAX_AGE", 300)
+)  # Seconds browsers and CDNs may keep tiles before revalidating their ETag
 
 # Global variables
-alpha = DEFAULT_ALPHA
+alpha = DEFAULT_ALPHA  # Legacy alpha of tiles requested without one, set by /set_alpha
 last_activity_time = time.time()  # Track last API call time
 heatmap_tile_makers = {}  # Dictionary to store heatmap tile makers per slide
+tile_cache = TileCache(max_bytes=TILE_CACHE_MAX_BYTES)  # Encoded overlay tiles
+tile_prefetcher = None  # Started below once build_tile_bytes is defined
 
 
 @app.route("/")
@@ -96,7 +134,7 @@ def get_dimensions():
         return jsonify(error="Slide not found"), 404
 
     try:
-        with h5py.File(slide_h5_path, "r") as f:
+        with h5_handle_pool.open(slide_h5_path) as f:
             height = int(f["level_0_height"][()])
             width = int(f["level_0_width"][()])
         return jsonify(height=height, width=width)
@@ -105,73 +143,532 @@ def get_dimensions():
         return jsonify(error="Could not retrieve slide dimensions"), 500
 
 
+def quantize_alpha(alpha_value):
+    """Clamp an alpha to [0, 1] and round it to a multiple of 1 / ALPHA_STEPS."""
+    return round(min(max(float(alpha_value), 0.0), 1.0) * ALPHA_STEPS) / ALPHA_STEPS
+
+
+def get_tile_version(slide):
+    """
+    Return the version of the slide and heatmap files of a slide, the last part of every tile cache key.
+
+    The version is the stat_key of the pooled handles the tiles are read through, so a
+    regenerated heatmap (or slide) file gets a new version exactly when its new contents
+    are read, and the tiles cached from the old file are not served anymore.
+    """
+    return (
+        h5_handle_pool.get_stat_key(os.path.join(S3_MOUNT_PATH, f"{slide}.h5")),
+        h5_handle_pool.get_stat_key(
+            os.path.join(S3_MOUNT_PATH, "heatmaps", f"{slide}_heatmap.h5")
+        ),
+    )
+
+
 @app.route("/tile/<string:slide>/<int:level>/<int:x>/<int:y>/", methods=["GET"])
 def get_tile(slide, level, x, y):
-    """Retrieve a tile for a specific slide and apply the heatmap overlay."""
+    """
+    Retrieve a tile for a specific slide and apply the heatmap overlay.
+
+    A tile requested with the alpha (and optionally colormap) query parameters is fully
+    determined by its URL and the slide and heatmap files, so it is sent with a strong ETag
+    and may be cached by browsers and CDNs for TILE_MAX_AGE before they revalidate it.
+    Without an alpha the tile follows the legacy global alpha and is not cached.
+    """
+    update_last_activity()
+    cacheable = "alpha" in request.args
+    try:
+        tile_alpha = quantize_alpha(request.args["alpha"]) if cacheable else alpha
+    except ValueError:
+        return jsonify(error="alpha must be a number between 0 and 1"), 400
+
+    colormap = request.args.get("colormap", HEATMAP_COLORMAP)
+    if colormap not in COLORMAP_LUTS:
+        return jsonify(error=f"Unknown colormap: {colormap}"), 400
+
+    cache_key = (slide, level, x, y, tile_alpha, colormap, get_tile_version(slide))
+    tile_bytes = tile_cache.get(cache_key)
+    if tile_prefetcher is not None:
+        tile_prefetcher.on_tile_request(cache_key, cache_hit=tile_bytes is not None)
+    if tile_bytes is None:
+        tile_bytes, error_response = build_tile_bytes(
+            slide, level, x, y, tile_alpha, colormap
+        )
+        if tile_bytes is None:
+            return error_response
+        tile_cache.put(cache_key, tile_bytes)
+
+    return tile_response(tile_bytes, cacheable=cacheable)
+
+
+@app.route("/slide_tile/<string:slide>/<int:level>/<int:x>/<int:y>/", methods=["GET"])
+def get_slide_tile(slide, level, x, y):
+    """
+    Retrieve the stored tile of a slide as is, without the heatmap.
+
+    Together with /heatmap_tile/ this lets the viewer layer the heatmap over the slide
+    itself, e.g. as two OpenSeadragon tiled images with the heatmap at an opacity, so a
+    change of alpha is applied in the browser and refetches no tiles.
+    """
+    update_last_activity()
+    cache_key = (slide, level, x, y, "slide", get_tile_version(slide))
+    tile_bytes = tile_cache.get(cache_key)
+    if tile_bytes is None:
+        slide_h5_path = os.path.join(S3_MOUNT_PATH, f"{slide}.h5")
+        if not os.path.exists(slide_h5_path):
+            return "Slide not found", 404
+        tile_bytes = retrieve_tile_bytes_h5(slide_h5_path, level, x, y)
+        if tile_bytes is None:
+            return "Tile not found", 404
+        tile_cache.put(cache_key, tile_bytes)
+
+    return tile_response(tile_bytes, cacheable=True)
+
+
+@app.route("/heatmap_tile/<string:slide>/<int:level>/<int:x>/<int:y>/", methods=["GET"])
+def get_heatmap_tile(slide, level, x, y):
+    """
+    Retrieve the heatmap layer of a tile alone, in the colormap query parameter.
+
+    The tile is a palettized PNG rendered from the score pyramid, a few kilobytes per tile,
+    meant to be drawn over /slide_tile/ at an opacity chosen in the viewer. Heatmap files
+    without a score pyramid serve their stored tile instead.
+    """
     update_last_activity()
+    colormap = request.args.get("colormap", HEATMAP_COLORMAP)
+    if colormap not in COLORMAP_LUTS:
+        return jsonify(error=f"Unknown colormap: {colormap}"), 400
+
+    cache_key = (slide, level, x, y, "heatmap", colormap, get_tile_version(slide))
+    tile_bytes = tile_cache.get(cache_key)
+    if tile_bytes is None:
+        heatmap_h5_path = os.path.join(S3_MOUNT_PATH, "heatmaps", f"{slide}_heatmap.h5")
+        if not os.path.exists(heatmap_h5_path):
+            return "Heatmap not found", 404
+        tile_bytes = retrieve_heatmap_layer_bytes(
+            heatmap_h5_path, level, x, y, colormap
+        )
+        if tile_bytes is None:
+            return "Tile not found", 404
+        tile_cache.put(cache_key, tile_bytes)
+
+    return tile_response(tile_bytes, cacheable=True)
+
+
+def build_tile_bytes(slide, level, x, y, tile_alpha, colormap):
+    """
+    Read or render the encoded bytes of a tile.
+
+    Returns:
+    - tuple: The (tile bytes, None), or (None, error response) if the tile can not be served.
+    """
     slide_h5_path = os.path.join(S3_MOUNT_PATH, f"{slide}.h5")
     heatmap_h5_path = os.path.join(S3_MOUNT_PATH, "heatmaps", f"{slide}_heatmap.h5")
 
+    # Slide only views serve the stored tile as is, without decoding
+    if tile_alpha <= 0:
+        if not os.path.exists(slide_h5_path):
+            return None, ("Slide not found", 404)
+        tile_bytes = retrieve_tile_bytes_h5(slide_h5_path, level, x, y)
+        if tile_bytes is None:
+            return None, ("Tile not found", 404)
+        return tile_bytes, None
+
     # Validate file existence
-    if not os.path.exists(slide_h5_path):
-        return "Slide not found", 404
     if not os.path.exists(heatmap_h5_path):
-        return "Heatmap not found", 404
+        return None, ("Heatmap not found", 404)
+    if tile_alpha < 1 and not os.path.exists(slide_h5_path):
+        return None, ("Slide not found", 404)
+
+    heatmap_tile_bytes = retrieve_heatmap_tile_bytes(
+        heatmap_h5_path, level, x, y, colormap
+    )
+    if heatmap_tile_bytes is None:
+        return None, ("Tile not found", 404)
+
+    # Heatmap only views need no blending, only a crop to the size of the slide tile
+    if tile_alpha >= 1:
+        slide_dimensions = retrieve_slide_dimensions(slide_h5_path)
+        if slide_dimensions is not None:
+            heatmap_tile_bytes = crop_tile_bytes(
+                heatmap_tile_bytes,
+                get_dz_tile_size(*slide_dimensions, level, x, y, HEATMAP_TILE_SIZE),
+            )
+            if heatmap_tile_bytes is None:
+                return None, ("Tile not found", 404)
+        return heatmap_tile_bytes, None
 
     try:
-        # Retrieve slide and heatmap tiles
-        slide_tile = retrieve_tile_h5(slide_h5_path, level, x, y)
-        heatmap_tile = retrieve_tile_h5(heatmap_h5_path, level, x, y)
+        slide_tile_bytes = retrieve_tile_bytes_h5(slide_h5_path, level, x, y)
+        if slide_tile_bytes is None:
+            return None, ("Tile not found", 404)
+        return blend_tile_bytes(slide_tile_bytes, heatmap_tile_bytes, tile_alpha), None
+    except Exception as e:
+        print(
+            f"Error serving tile at level {level}, row {x}, col {y} for slide '{slide}': {e}"
+        )
+        return None, (jsonify({"error": f"Tile not found: {str(e)}"}), 404)
 
-        if slide_tile is None or heatmap_tile is None:
-            return "Tile not found", 404
 
-        # Apply the overlay
-        overlay_image = get_heatmap_overlay(
-            np.array(slide_tile.convert("RGB")), heatmap_tile, alpha=alpha
+def prefetch_tile_bytes(cache_key):
+    """Build the tile of a /tile/ cache key for the prefetcher, None if it can not be served."""
+    # the error responses of build_tile_bytes need an app context outside of a request
+    with app.app_context():
+        slide, level, x, y, tile_alpha, colormap, _ = cache_key
+        tile_bytes, _ = build_tile_bytes(slide, level, x, y, tile_alpha, colormap)
+    return tile_bytes
+
+
+if TILE_PREFETCH_WORKERS > 0:
+    tile_prefetcher = TilePrefetcher(
+        tile_cache, prefetch_tile_bytes, num_workers=TILE_PREFETCH_WORKERS
+    )
+
+
+def blend_tile_bytes(slide_tile_bytes, heatmap_tile_bytes, tile_alpha):
+    """Blend an encoded heatmap tile over an encoded slide tile and encode the overlay as a JPEG."""
+    overlay_image = get_heatmap_overlay(
+        np.array(Image.open(io.BytesIO(slide_tile_bytes)).convert("RGB")),
+        Image.open(io.BytesIO(heatmap_tile_bytes)),
+        alpha=tile_alpha,
+    )
+
+    # Encode the overlay once and keep it for repeated views of the same tile
+    img_io = io.BytesIO()
+    Image.fromarray(overlay_image).save(img_io, format="JPEG", quality=90)
+    return img_io.getvalue()
+
+
+@app.route("/tiles/batch", methods=["POST"])
+def get_tiles_batch():
+    """
+    Retrieve many tiles of a slide in one request, e.g. all the tiles of a viewport.
+
+    The JSON body has the slide, the tiles as a list of [level, x, y], and optionally the
+    alpha and colormap of /tile/. The tiles that are not in the tile cache are read in one
+    pass over each file, sorted by HDF5 chunk. The response streams every tile as a
+    BATCH_TILE_HEADER followed by its bytes, in no particular order, and a tile that can
+    not be served has a length of 0.
+    """
+    update_last_activity()
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict) or not isinstance(body.get("slide"), str):
+        return jsonify(error="The body must be a JSON object with a slide"), 400
+    slide = body["slide"]
+
+    try:
+        # duplicate tiles are only sent once
+        tiles = list(
+            dict.fromkeys(
+                (int(level), int(x), int(y)) for level, x, y in body.get("tiles", [])
+            )
         )
+    except (TypeError, ValueError):
+        return jsonify(error="tiles must be a list of [level, x, y]"), 400
+    # the values must fit the unsigned 32 bit fields of BATCH_TILE_HEADER, checked before
+    # streaming starts as the response status can not change afterwards
+    if not all(
+        0 <= level <= MAX_TILE_LEVEL and 0 <= x < 2**32 and 0 <= y < 2**32
+        for level, x, y in tiles
+    ):
+        return jsonify(error="tiles must be a list of [level, x, y]"), 400
+    if len(tiles) > MAX_BATCH_TILES:
+        return jsonify(error=f"At most {MAX_BATCH_TILES} tiles per batch"), 400
+
+    try:
+        tile_alpha = quantize_alpha(body["alpha"]) if "alpha" in body else alpha
+    except (TypeError, ValueError):
+        return jsonify(error="alpha must be a number between 0 and 1"), 400
+
+    colormap = body.get("colormap", HEATMAP_COLORMAP)
+    if colormap not in COLORMAP_LUTS:
+        return jsonify(error=f"Unknown colormap: {colormap}"), 400
+
+    version = get_tile_version(slide)
+    cached_tiles = {}
+    missing_tiles = []
+    for tile in tiles:
+        tile_bytes = tile_cache.get((slide, *tile, tile_alpha, colormap, version))
+        if tile_bytes is None:
+            missing_tiles.append(tile)
+        else:
+            cached_tiles[tile] = tile_bytes
+
+    def generate():
+        for tile, tile_bytes in cached_tiles.items():
+            yield BATCH_TILE_HEADER.pack(*tile, len(tile_bytes)) + tile_bytes
+
+        for tile, tile_bytes in build_many_tile_bytes(
+            slide, missing_tiles, tile_alpha, colormap
+        ):
+            if tile_bytes is None:
+                yield BATCH_TILE_HEADER.pack(*tile, 0)
+                continue
+            tile_cache.put((slide, *tile, tile_alpha, colormap, version), tile_bytes)
+            yield BATCH_TILE_HEADER.pack(*tile, len(tile_bytes)) + tile_bytes
+
+    response = Response(
+        stream_with_context(generate()), mimetype="application/octet-stream"
+    )
+    response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
+    return response
+
+
+def build_many_tile_bytes(slide, tiles, tile_alpha, colormap):
+    """
+    Read or render the encoded bytes of many tiles of a slide, like build_tile_bytes.
+
+    Each file is checked for and opened once, and its tiles are read in chunk order.
 
-        # Convert overlay to image and send response
-        img_io = io.BytesIO()
-        Image.fromarray(overlay_image).save(img_io, format="JPEG", quality=90)
-        img_io.seek(0)
-        response = make_response(send_file(img_io, mimetype="image/jpeg"))
+    Yields:
+    - tuple: The (level, x, y) and the tile bytes of every tile, None if the tile can not be served.
+    """
+    if not tiles:
+        return
+
+    slide_h5_path = os.path.join(S3_MOUNT_PATH, f"{slide}.h5")
+    heatmap_h5_path = os.path.join(S3_MOUNT_PATH, "heatmaps", f"{slide}_heatmap.h5")
+
+    slide_tiles_bytes = {}
+    if tile_alpha < 1 and os.path.exists(slide_h5_path):
+        slide_tiles_bytes = retrieve_many_tile_bytes_h5(slide_h5_path, tiles)
+    heatmap_tiles_bytes = {}
+    if tile_alpha > 0 and os.path.exists(heatmap_h5_path):
+        heatmap_tiles_bytes = retrieve_many_heatmap_tile_bytes(
+            heatmap_h5_path, tiles, colormap
+        )
+
+    slide_dimensions = None
+    if tile_alpha >= 1 and os.path.exists(slide_h5_path):
+        slide_dimensions = retrieve_slide_dimensions(slide_h5_path)
+
+    for tile in tiles:
+        slide_tile_bytes = slide_tiles_bytes.get(tile)
+        heatmap_tile_bytes = heatmap_tiles_bytes.get(tile)
+        if tile_alpha <= 0:
+            yield tile, slide_tile_bytes
+        elif tile_alpha >= 1:
+            if heatmap_tile_bytes is not None and slide_dimensions is not None:
+                heatmap_tile_bytes = crop_tile_bytes(
+                    heatmap_tile_bytes,
+                    get_dz_tile_size(*slide_dimensions, *tile, HEATMAP_TILE_SIZE),
+                )
+            yield tile, heatmap_tile_bytes
+        elif slide_tile_bytes is None or heatmap_tile_bytes is None:
+            yield tile, None
+        else:
+            try:
+                yield tile, blend_tile_bytes(
+                    slide_tile_bytes, heatmap_tile_bytes, tile_alpha
+                )
+            except Exception as e:
+                print(f"Error blending tile {tile} for slide '{slide}': {e}")
+                yield tile, None
+
+
+def retrieve_slide_dimensions(slide_h5_path):
+    """Retrieve the (width, height) at level 0 stored in a slide HDF5 file, None if it can not be read."""
+    try:
+        with h5_handle_pool.open(slide_h5_path) as f:
+            return int(f["level_0_width"][()]), int(f["level_0_height"][()])
+    except Exception as e:
+        print(f"Error reading the dimensions of {slide_h5_path}: {e}")
+        return None
+
+
+def crop_tile_bytes(tile_bytes, tile_size):
+    """
+    Crop an encoded tile to a (width, height), like the slide tiles at the edges of a level.
+
+    Tiles that are not larger than that are returned as they are, without decoding, and
+    None is returned for tiles past the edge of the level.
+    """
+    tile_image = Image.open(io.BytesIO(tile_bytes))
+    width, height = tile_size
+    if width == 0 or height == 0:
+        return None
+    if tile_image.width <= width and tile_image.height <= height:
+        return tile_bytes
+
+    buffer = io.BytesIO()
+    cropped_image = tile_image.crop((0, 0, width, height))
+    if tile_image.format == "PNG":
+        cropped_image.save(buffer, format="PNG")
+    else:
+        cropped_image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def tile_response(tile_bytes, cacheable=False):
+    """
+    Wrap encoded tile bytes in a response, detecting PNG from its signature.
+
+    Cacheable responses carry a strong ETag of the bytes and a max-age of TILE_MAX_AGE, and
+    become a 304 Not Modified when the request already has the same ETag. They are not
+    immutable, as the heatmap file behind a URL can be regenerated.
+    """
+    mimetype = "image/png" if tile_bytes.startswith(PNG_SIGNATURE) else "image/jpeg"
+    response = make_response(
+        send_file(io.BytesIO(tile_bytes), mimetype=mimetype, etag=False)
+    )
+    if not cacheable:
         response.headers["Cache-Control"] = (
             "no-store, no-cache, must-revalidate, max-age=0"
         )
         return response
+
+    response.set_etag(hashlib.blake2b(tile_bytes, digest_size=16).hexdigest())
+    response.headers["Cache-Control"] = f"public, max-age={TILE_MAX_AGE}"
+    return response.make_conditional(request)
+
+
+@app.route("/cache_stats", methods=["GET"])
+def get_cache_stats():
+    """Report the tile cache, tile prefetcher and HDF5 handle pool counters."""
+    return jsonify(
+        tile_cache=tile_cache.stats(),
+        tile_prefetcher=tile_prefetcher.stats() if tile_prefetcher else None,
+        h5_handle_pool=h5_handle_pool.stats(),
+    )
+
+
+def retrieve_tile_bytes_h5(h5_path, level, row, col):
+    """Retrieve the encoded tile bytes stored in an HDF5 file."""
+    try:
+        with h5_handle_pool.open(h5_path) as f:
+            return read_tile_bytes(f, level, row, col)
+    except Exception as e:
+        print(f"Error retrieving tile at level {level}, row {row}, col {col}: {e}")
+        return None
+
+
+def retrieve_many_tile_bytes_h5(h5_path, tiles):
+    """Retrieve the encoded bytes of many tiles stored in an HDF5 file, by (level, row, col)."""
+    try:
+        with h5_handle_pool.open(h5_path) as f:
+            return read_many_tile_bytes(f, tiles)
+    except Exception as e:
+        print(f"Error retrieving {len(tiles)} tiles from {h5_path}: {e}")
+        return {}
+
+
+def retrieve_many_heatmap_tile_bytes(heatmap_h5_path, tiles, colormap):
+    """
+    Retrieve many encoded heatmap tiles in a colormap, by (level, x, y).
+
+    Like retrieve_heatmap_tile_bytes, tiles in another colormap than the stored one are
+    rendered from the score pyramid.
+    """
+    heatmap_tiles_bytes = {}
+    try:
+        with h5_handle_pool.open(heatmap_h5_path) as f:
+            if f.attrs.get("colormap", HEATMAP_COLORMAP) == colormap:
+                return read_many_tile_bytes(f, tiles)
+
+            for level, x, y in sorted(tiles):
+                scores = read_heatmap_tile_scores(f, level, x, y)
+                heatmap_tiles_bytes[(level, x, y)] = render_heatmap_tile_bytes(
+                    scores, colormap
+                )
     except Exception as e:
         print(
-            f"Error serving tile at level {level}, row {x}, col {y} for slide '{slide}': {e}"
+            f"Error retrieving {len(tiles)} heatmap tiles from {heatmap_h5_path}: {e}"
         )
-        return jsonify({"error": f"Tile not found: {str(e)}"}), 404
+    return heatmap_tiles_bytes
 
 
-def retrieve_tile_h5(h5_path, level, row, col):
-    """Retrieve tile from an HDF5 file."""
+def retrieve_heatmap_tile_bytes(heatmap_h5_path, level, x, y, colormap):
+    """
+    Retrieve the encoded heatmap tile in a colormap.
+
+    Tiles in the colormap the pyramid was rendered with are read as stored, and tiles in any
+    other colormap are rendered from the score pyramid of the heatmap file.
+    """
     try:
-        with h5py.File(h5_path, "r") as f:
-            jpeg_string = base64.b64decode(f[str(level)][row, col])
-            image = Image.open(io.BytesIO(jpeg_string))
-            return image
+        with h5_handle_pool.open(heatmap_h5_path) as f:
+            if f.attrs.get("colormap", HEATMAP_COLORMAP) == colormap:
+                return read_tile_bytes(f, level, x, y)
+
+            scores = read_heatmap_tile_scores(f, level, x, y)
     except Exception as e:
-        print(f"Error retrieving tile at level {level}, row {row}, col {col}: {e}")
+        print(f"Error retrieving heatmap tile at level {level}, row {x}, col {y}: {e}")
         return None
 
+    return render_heatmap_tile_bytes(scores, colormap)
+
+
+def render_heatmap_tile_bytes(scores, colormap):
+    """Color the scores of a heatmap tile with a colormap and encode them as a JPEG."""
+    buffer = io.BytesIO()
+    Image.fromarray(apply_colormap(scores, colormap)).save(
+        buffer, format="JPEG", quality=90
+    )
+    return buffer.getvalue()
+
+
+def retrieve_heatmap_layer_bytes(heatmap_h5_path, level, x, y, colormap):
+    """
+    Retrieve the heatmap tile in a colormap as a palettized PNG for client side blending.
+
+    Like the slide tiles, the tiles at the right and bottom edges of a level are cropped
+    to the level, so the layer lines up with /slide_tile/. Heatmap files without a score
+    pyramid only have their stored tiles, which are served in the colormap they were
+    rendered with.
+    """
+    try:
+        with h5_handle_pool.open(heatmap_h5_path) as f:
+            tile_size = get_heatmap_tile_size(f, level, x, y)
+            if "pyramid" not in f:
+                if f.attrs.get("colormap", HEATMAP_COLORMAP) != colormap:
+                    return None
+                tile_bytes = read_tile_bytes(f, level, x, y)
+                if tile_size is None:
+                    return tile_bytes
+                return crop_tile_bytes(tile_bytes, tile_size)
+
+            scores = read_heatmap_tile_scores(f, level, x, y)
+    except Exception as e:
+        print(f"Error retrieving heatmap tile at level {level}, row {x}, col {y}: {e}")
+        return None
+
+    if tile_size is not None:
+        # the scores are indexed as [row, col], i.e. [y, x]
+        tile_width, tile_height = tile_size
+        if tile_width == 0 or tile_height == 0:
+            return None
+        scores = scores[:tile_height, :tile_width]
+    return encode_palettized_heatmap_tile(scores, colormap)
+
+
+def get_heatmap_tile_size(f, level, x, y):
+    """Return the (width, height) of a heatmap tile from the slide dimensions in an open heatmap file, None if it has none."""
+    if "level_0_width" not in f or "level_0_height" not in f:
+        return None
+    return get_dz_tile_size(
+        int(f["level_0_width"][()]),
+        int(f["level_0_height"][()]),
+        level,
+        x,
+        y,
+        HEATMAP_TILE_SIZE,
+    )
+
+
+def read_heatmap_tile_scores(f, level, x, y):
+    """Read the scores of a heatmap tile from the score pyramid of an open heatmap file."""
+    # only the cells of this tile are read from the score pyramid
+    pyramid = {int(key): dataset for key, dataset in f["pyramid"].items()}
+    return get_dz_tile_scores(pyramid, level, x, y, tile_size=HEATMAP_TILE_SIZE)
+
 
 def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
     """Create overlay of region and heatmap."""
     heatmap_image = np.array(heatmap_image.convert("RGB"))
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image[: region.shape[0], : region.shape[1]]
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    return (np.clip(overlay_image_np, 0, 1) * 255).astype(np.uint8)
+    return blend_overlay(region, heatmap_image, alpha=alpha)
 
 
 @app.route("/set_alpha", methods=["POST"])
 def set_alpha():
-    """Set the transparency level for the overlay."""
+    """Set the legacy transparency level of tiles requested without an alpha query parameter."""
     update_last_activity()
     global alpha
     try:
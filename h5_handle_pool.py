@@ -0,0 +1,222 @@
+import os
+import time
+import threading
+import h5py
+from collections import OrderedDict
+from contextlib import contextmanager
+
+MAX_OPEN_HANDLES = 64
+MAX_IDLE_SECONDS = 600  # Close handles that have not been used for this long
+REVALIDATE_SECONDS = 5  # Minimum time between os.stat checks of a pooled file
+
+
+class PooledH5Handle:
+    """
+    === Attributes ===
+    - path: the path of the HDF5 file
+    - file: the open read-only h5py.File object
+    - stat_key: the (mtime_ns, size) of the file when it was opened
+    - last_used: the time the handle was last handed out
+    - last_validated: the time the stat_key was last checked against the file on disk
+    - num_users: the number of callers currently holding the handle
+    - retired: whether the handle has been removed from the pool and must be closed once released
+    """
+
+    def __init__(self, path, file, stat_key):
+        self.path = path
+        self.file = file
+        self.stat_key = stat_key
+        self.last_used = time.time()
+        self.last_validated = self.last_used
+        self.num_users = 0
+        self.retired = False
+
+
+class H5HandlePool:
+    """
+    A thread-safe pool of open read-only HDF5 handles keyed by path.
+
+    Opening an HDF5 file through the s3fs mount re-reads the superblock and B-tree
+    metadata every time, so the tile servers keep the handles open between requests.
+    Handles are evicted least-recently-used first once there are more than max_handles,
+    closed after max_idle_seconds without use, and reopened when the mtime or size of
+    the file on disk changes.
+
+    === Attributes ===
+    - max_handles: the maximum number of handles kept open
+    - max_idle_seconds: the time after which an unused handle is closed
+    - revalidate_seconds: the minimum time between two os.stat checks of the same file
+    - num_hits: the number of requests served by an already open handle
+    - num_opens: the number of times a file was opened
+    - num_evictions: the number of handles closed because of the count or idle limit
+    - num_invalidations: the number of handles closed because the file changed on disk
+    """
+
+    def __init__(
+        self,
+        max_handles=MAX_OPEN_HANDLES,
+        max_idle_seconds=MAX_IDLE_SECONDS,
+        revalidate_seconds=REVALIDATE_SECONDS,
+    ):
+        self.max_handles = max_handles
+        self.max_idle_seconds = max_idle_seconds
+        self.revalidate_seconds = revalidate_seconds
+
+        self.num_hits = 0
+        self.num_opens = 0
+        self.num_evictions = 0
+        self.num_invalidations = 0
+
+        self._lock = threading.Lock()
+        self._handles = OrderedDict()  # path -> PooledH5Handle, least recently used first
+        self._pid = os.getpid()
+
+    @contextmanager
+    def open(self, path):
+        """
+        Borrow an open read-only h5py.File for the given path.
+
+        The handle must not be closed by the caller and must not be used after the
+        with block exits.
+        """
+        handle = self._acquire(path)
+        try:
+            yield handle.file
+        finally:
+            self._release(handle)
+
+    def _acquire(self, path):
+        now = time.time()
+
+        with self._lock:
+            self._check_fork()
+            self._evict_idle(now)
+
+            handle = self._revalidate(path, now)
+            if handle is not None:
+                self._handles.move_to_end(path)
+                handle.last_used = now
+                handle.num_users += 1
+                self.num_hits += 1
+                return handle
+
+        # Open outside the lock so a slow open over s3fs does not block other slides
+        stat_key = self._stat_key(path)
+        new_handle = PooledH5Handle(path, h5py.File(path, "r"), stat_key)
+
+        with self._lock:
+            self.num_opens += 1
+            handle = self._handles.get(path)
+            if handle is not None and handle.stat_key == stat_key:
+                # Another thread opened the same file in the meantime, keep theirs
+                new_handle.file.close()
+            else:
+                if handle is not None:
+                    self._retire(path)
+                    self.num_invalidations += 1
+                handle = new_handle
+                self._handles[path] = handle
+                self._evict_over_capacity()
+
+            self._handles.move_to_end(path)
+            handle.last_used = now
+            handle.num_users += 1
+            return handle
+
+    def get_stat_key(self, path):
+        """
+        Return the (mtime_ns, size) of the file the pool serves for a path, None if it does not exist.
+
+        An open handle is revalidated like when it is borrowed and its stat_key returned,
+        so a tile version derived from it changes exactly when the handle tiles are read
+        from does.
+        """
+        with self._lock:
+            self._check_fork()
+            handle = self._revalidate(path, time.time())
+            if handle is not None:
+                return handle.stat_key
+
+        try:
+            return self._stat_key(path)
+        except OSError:
+            return None
+
+    def _revalidate(self, path, now):
+        """Return the pooled handle of a path, None if there is none or the file changed on disk."""
+        handle = self._handles.get(path)
+        if handle is None or now - handle.last_validated < self.revalidate_seconds:
+            return handle
+
+        try:
+            stat_key = self._stat_key(path)
+        except OSError:
+            stat_key = None
+        if stat_key != handle.stat_key:
+            self._retire(path)
+            self.num_invalidations += 1
+            return None
+
+        handle.last_validated = now
+        return handle
+
+    def _release(self, handle):
+        with self._lock:
+            handle.num_users -= 1
+            if handle.retired and handle.num_users == 0:
+                handle.file.close()
+
+    def _retire(self, path):
+        """Remove the handle from the pool, closing it now if no one is using it."""
+        handle = self._handles.pop(path)
+        handle.retired = True
+        if handle.num_users == 0:
+            handle.file.close()
+
+    def _evict_over_capacity(self):
+        while len(self._handles) > self.max_handles:
+            oldest_path = next(iter(self._handles))
+            self._retire(oldest_path)
+            self.num_evictions += 1
+
+    def _evict_idle(self, now):
+        idle_paths = [
+            path
+            for path, handle in self._handles.items()
+            if handle.num_users == 0 and now - handle.last_used > self.max_idle_seconds
+        ]
+        for path in idle_paths:
+            self._retire(path)
+            self.num_evictions += 1
+
+    def _check_fork(self):
+        """Drop handles inherited from a parent process, HDF5 handles must not cross a fork."""
+        if os.getpid() != self._pid:
+            self._handles = OrderedDict()
+            self._pid = os.getpid()
+
+    @staticmethod
+    def _stat_key(path):
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def close_all(self):
+        """Close every pooled handle, handles still in use are closed once released."""
+        with self._lock:
+            for path in list(self._handles):
+                self._retire(path)
+
+    def stats(self):
+        """Return the pool counters as a dictionary."""
+        with self._lock:
+            return {
+                "open_handles": len(self._handles),
+                "hits": self.num_hits,
+                "opens": self.num_opens,
+                "evictions": self.num_evictions,
+                "invalidations": self.num_invalidations,
+            }
+
+
+# Process-wide pool shared by every request handler
+h5_handle_pool = H5HandlePool()
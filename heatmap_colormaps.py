@@ -0,0 +1,72 @@
+import numpy as np
+
+COLORMAP_SIZE = 256
+DEFAULT_COLORMAP = "RedGreen"
+
+# The colors of each colormap, evenly spaced over scores from 0 to 1
+COLORMAP_COLORS = {
+    "RedGreen": [(1.0, 0.0, 0.0), (0.0, 128 / 255, 0.0)],  # matplotlib "red" to "green"
+}
+
+
+def make_colormap_lut(colors, size=COLORMAP_SIZE):
+    """
+    Build the uint8 lookup table of a colormap interpolating linearly between colors.
+
+    The table matches LinearSegmentedColormap.from_list(name, colors, N=size) evaluated
+    and converted with (rgba[:, :, :3] * 255).astype(np.uint8), without matplotlib.
+
+    Parameters:
+    - colors (list): The RGB colors as floats in [0, 1], evenly spaced over [0, 1].
+    - size (int): The number of entries of the table.
+
+    Returns:
+    - np.ndarray: The (size, 3) uint8 lookup table.
+    """
+    colors = np.asarray(colors, dtype=np.float64)
+    color_positions = np.linspace(0, 1, len(colors))
+    lut_positions = np.linspace(0, 1, size)
+
+    lut = np.stack(
+        [
+            np.interp(lut_positions, color_positions, colors[:, channel])
+            for channel in range(3)
+        ],
+        axis=1,
+    )
+    return (lut * 255).astype(np.uint8)
+
+
+COLORMAP_LUTS = {
+    name: make_colormap_lut(colors) for name, colors in COLORMAP_COLORS.items()
+}
+
+
+def quantize_scores(matrix, size=COLORMAP_SIZE):
+    """
+    Quantize scores to lookup table indices, the way matplotlib colormaps index their table.
+
+    Parameters:
+    - matrix (np.ndarray): The scores, clipped to [0, 1].
+    - size (int): The number of entries of the lookup table.
+
+    Returns:
+    - np.ndarray: The uint8 indices, of the same shape as matrix.
+    """
+    scores = np.clip(matrix, 0, 1) * size
+    np.minimum(scores, size - 1, out=scores)
+    return scores.astype(np.uint8)
+
+
+def apply_colormap(matrix, colormap=DEFAULT_COLORMAP):
+    """
+    Color a matrix of scores with a colormap lookup table.
+
+    Parameters:
+    - matrix (np.ndarray): A 2D array of scores between 0 and 1.
+    - colormap (str): The name of the colormap, a key of COLORMAP_LUTS.
+
+    Returns:
+    - np.ndarray: The (height, width, 3) uint8 RGB image.
+    """
+    return COLORMAP_LUTS[colormap][quantize_scores(matrix)]
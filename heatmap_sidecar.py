@@ -0,0 +1,171 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+from read_heatmap import HEATMAP_DTYPES, HeatMapTileLoader, LazyHeatmapPyramid
+
+# A sidecar starts with a header page holding SIDECAR_MAGIC and a JSON index of the levels,
+# followed by the raw C order score grid of every DZ level, each at a page aligned offset
+SIDECAR_MAGIC = b"HEATMAP_PYRAMID_V1\n"
+SIDECAR_PAGE_SIZE = 4096
+SIDECAR_EXTENSION = ".pyramid.bin"
+
+
+def get_heatmap_sidecar_path(heatmap_h5_path):
+    """Return the sidecar path of a heatmap h5 file, next to it."""
+    return os.path.splitext(heatmap_h5_path)[0] + SIDECAR_EXTENSION
+
+
+def align_to_page(offset):
+    """Round an offset up to the next multiple of SIDECAR_PAGE_SIZE."""
+    return -(-offset // SIDECAR_PAGE_SIZE) * SIDECAR_PAGE_SIZE
+
+
+def export_heatmap_sidecar(heatmap_h5_path, sidecar_path=None, heatmap_dtype=None):
+    """
+    Write the score pyramid of a heatmap h5 file to a flat, page aligned sidecar file.
+
+    The sidecar is written to a temporary file and renamed into place, so a server never
+    maps a partially written sidecar even if several workers export it at once.
+
+    Parameters:
+    - heatmap_h5_path (str): The path of the heatmap h5 file.
+    - sidecar_path (str): The path of the sidecar, defaults to get_heatmap_sidecar_path(heatmap_h5_path).
+    - heatmap_dtype (str): The dtype of the levels, one of HEATMAP_DTYPES, None for the dtype of the heatmap.
+
+    Returns:
+    - str: The path of the sidecar.
+    """
+    if sidecar_path is None:
+        sidecar_path = get_heatmap_sidecar_path(heatmap_h5_path)
+
+    with h5py.File(heatmap_h5_path, "r") as f:
+        heatmap = np.array(f["heatmap"])
+
+    pyramid = LazyHeatmapPyramid(heatmap, heatmap_dtype=heatmap_dtype)
+
+    index = {"dtype": pyramid.heatmap_dtype, "levels": {}}
+    offset = SIDECAR_PAGE_SIZE
+    for level in pyramid:
+        score_grid = pyramid[level]
+        index["levels"][str(level)] = {"offset": offset, "shape": score_grid.shape}
+        offset = align_to_page(offset + score_grid.nbytes)
+
+    header = SIDECAR_MAGIC + json.dumps(index).encode()
+    if len(header) > SIDECAR_PAGE_SIZE:
+        raise ValueError(f"Sidecar header of {len(header)} bytes does not fit a page")
+
+    tmp_sidecar_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_sidecar_path, "wb") as f:
+            f.write(header)
+            for level in pyramid:
+                f.seek(index["levels"][str(level)]["offset"])
+                f.write(np.ascontiguousarray(pyramid[level]).tobytes())
+            f.truncate(offset)
+        os.replace(tmp_sidecar_path, sidecar_path)
+    except Exception as e:
+        if os.path.exists(tmp_sidecar_path):
+            os.remove(tmp_sidecar_path)
+        raise e
+
+    print(f"Exported the heatmap pyramid of {heatmap_h5_path} to {sidecar_path}")
+    return sidecar_path
+
+
+def open_heatmap_sidecar(sidecar_path):
+    """
+    Memory map the score pyramid of a sidecar read only.
+
+    Every process mapping the same sidecar shares one copy of it in the page cache, and
+    the pages are only read from disk when a tile first touches them.
+
+    Parameters:
+    - sidecar_path (str): The path of the sidecar.
+
+    Returns:
+    - dict: The score grid of every DZ level, as read only np.memmap arrays.
+    """
+    with open(sidecar_path, "rb") as f:
+        header = f.read(SIDECAR_PAGE_SIZE)
+
+    if not header.startswith(SIDECAR_MAGIC):
+        raise ValueError(f"{sidecar_path} is not a heatmap sidecar")
+    index = json.loads(header[len(SIDECAR_MAGIC) :].rstrip(b"\0"))
+    dtype = np.dtype(index["dtype"])
+
+    levels = {}
+    for level, level_index in index["levels"].items():
+        shape = tuple(level_index["shape"])
+        if np.prod(shape) == 0:
+            # an empty file region can not be mapped
+            levels[int(level)] = np.zeros(shape, dtype=dtype)
+            continue
+        levels[int(level)] = np.memmap(
+            sidecar_path,
+            dtype=dtype,
+            mode="r",
+            offset=level_index["offset"],
+            shape=shape,
+        )
+    return levels
+
+
+def is_heatmap_sidecar_current(heatmap_h5_path, sidecar_path):
+    """Return whether the sidecar exists and is not older than the heatmap h5 file."""
+    return os.path.exists(sidecar_path) and os.path.getmtime(
+        sidecar_path
+    ) >= os.path.getmtime(heatmap_h5_path)
+
+
+def load_heatmap_tile_loader(
+    heatmap_h5_path, tile_size=512, export_missing=False, max_cached_bytes=None
+):
+    """
+    Load the HeatMapTileLoader of a heatmap h5 file from its memory mapped sidecar.
+
+    A missing or outdated sidecar is exported first if export_missing, otherwise (and if
+    the export fails, e.g. the directory is read only) the heatmap is read into memory.
+    Sidecars are exported with the heatmap by dz_save_h5_heatmap or this module's script.
+
+    Parameters:
+    - heatmap_h5_path (str): The path of the heatmap h5 file.
+    - tile_size (int): The size of the tiles.
+    - export_missing (bool): Whether to export a missing or outdated sidecar.
+    - max_cached_bytes (int): The memory cap of the pyramid levels when the heatmap is read into memory.
+
+    Returns:
+    - HeatMapTileLoader: The tile loader.
+    """
+    sidecar_path = get_heatmap_sidecar_path(heatmap_h5_path)
+
+    if export_missing and not is_heatmap_sidecar_current(heatmap_h5_path, sidecar_path):
+        try:
+            export_heatmap_sidecar(heatmap_h5_path, sidecar_path)
+        except OSError as e:
+            print(f"Could not export the heatmap sidecar {sidecar_path}: {e}")
+
+    if is_heatmap_sidecar_current(heatmap_h5_path, sidecar_path):
+        levels = open_heatmap_sidecar(sidecar_path)
+        return HeatMapTileLoader(
+            np_heatmap=levels[18], tile_size=tile_size, stored_levels=levels
+        )
+
+    with h5py.File(heatmap_h5_path, "r") as f:
+        heatmap = np.array(f["heatmap"])
+    return HeatMapTileLoader(
+        np_heatmap=heatmap, tile_size=tile_size, max_cached_bytes=max_cached_bytes
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export the score pyramids of heatmap h5 files to memory mappable sidecars."
+    )
+    parser.add_argument("heatmap_h5_paths", nargs="+")
+    parser.add_argument("--heatmap_dtype", default=None, choices=HEATMAP_DTYPES)
+    args = parser.parse_args()
+
+    for heatmap_h5_path in args.heatmap_h5_paths:
+        export_heatmap_sidecar(heatmap_h5_path, heatmap_dtype=args.heatmap_dtype)
@@ -1,12 +1,13 @@
 from flask import Flask, send_file, request, jsonify, make_response
 from flask_cors import CORS
 from PIL import Image
+from tile_h5 import read_tile_bytes
 import h5py
 import io
 import numpy as np
 import os
-import base64
-from read_heatmap import HeatMapTileLoader  # Ensure this module is accessible
+from read_heatmap import blend_overlay  # Ensure this module is accessible
+from heatmap_sidecar import load_heatmap_tile_loader
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})  # Allows requests from any origin
@@ -35,10 +36,7 @@ except Exception as e:
     height, width = None, None
 
 try:
-    with h5py.File(heatmap_h5_path, "r") as f:
-        heatmap = np.array(f["heatmap"])
-        heatmap_tile_maker = HeatMapTileLoader(np_heatmap=heatmap, tile_size=TILE_SIZE)
-        heatmap_tile_maker.compute_heatmap()
+    heatmap_tile_maker = load_heatmap_tile_loader(heatmap_h5_path, tile_size=TILE_SIZE)
     print("Heatmap initialized successfully")
 except Exception as e:
     print(f"Error loading heatmap: {e}")
@@ -49,7 +47,7 @@ def retrieve_tile_h5(h5_path, level, row, col):
     """Retrieve tile from an HDF5 file."""
     try:
         with h5py.File(h5_path, "r") as f:
-            jpeg_string = base64.b64decode(f[str(level)][row, col])
+            jpeg_string = read_tile_bytes(f, level, row, col)
             image = Image.open(io.BytesIO(jpeg_string))
             return image
     except Exception as e:
@@ -60,11 +58,7 @@ def retrieve_tile_h5(h5_path, level, row, col):
 def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
     """Create overlay of region and heatmap."""
     heatmap_image = np.array(heatmap_image.convert("RGB"))
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image[: region.shape[0], : region.shape[1]]
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    return (np.clip(overlay_image_np, 0, 1) * 255).astype(np.uint8)
+    return blend_overlay(region, heatmap_image, alpha=alpha)
 
 
 @app.route("/dimensions", methods=["GET"])
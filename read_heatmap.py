@@ -1,7 +1,22 @@
+import io
 import h5py
+import itertools
+import threading
 import numpy as np
+from collections.abc import Mapping
 from PIL import Image
-from matplotlib.colors import LinearSegmentedColormap
+from heatmap_colormaps import (
+    COLORMAP_LUTS,
+    DEFAULT_COLORMAP,
+    apply_colormap,
+    quantize_scores,
+)
+
+# The dtypes a heatmap can be stored in, in memory and in the heatmap h5 file
+HEATMAP_DTYPES = ["float64", "float32", "float16", "uint8"]
+# A uint8 heatmap cell always stores round(score * HEATMAP_UINT8_MAX), for scores in
+# [0, 1], so the dtype alone tells readers how to get the scores back
+HEATMAP_UINT8_MAX = 255
 
 
 def generate_red_green_heatmap(matrix):
@@ -14,17 +29,8 @@ def generate_red_green_heatmap(matrix):
     Returns:
     - heatmap_pil (PIL.Image.Image): The heatmap image as a PIL Image object.
     """
-    # Define the custom colormap: red for 0, green for 1
-    red_green_cmap = LinearSegmentedColormap.from_list("RedGreen", ["red", "green"])
-
-    # Normalize the matrix to range [0, 1] if needed (you mentioned values are between 0 and 1)
-    normalized_matrix = np.clip(matrix, 0, 1)  # Ensure values are in [0, 1]
-
-    # Apply the colormap to the matrix
-    heatmap_image = red_green_cmap(normalized_matrix)
-
-    # Remove the alpha channel from the resulting image (if it exists)
-    heatmap_image = (heatmap_image[:, :, :3] * 255).astype(np.uint8)
+    # Look up the precomputed red for 0, green for 1 colormap
+    heatmap_image = apply_colormap(matrix, "RedGreen")
 
     # Convert the NumPy array to a PIL Image
     heatmap_pil = Image.fromarray(heatmap_image)
@@ -32,6 +38,28 @@ def generate_red_green_heatmap(matrix):
     return heatmap_pil
 
 
+def encode_palettized_heatmap_tile(scores, colormap=DEFAULT_COLORMAP):
+    """
+    Encode the scores of a heatmap tile as a palettized PNG colored with a colormap.
+
+    Every pixel is one byte indexing the colors of the colormap, and the cells of a tile
+    are uniform squares, so the PNG is a few kilobytes and lossless unlike a JPEG tile.
+
+    Parameters:
+    - scores (np.ndarray): The 2D scores between 0 and 1.
+    - colormap (str): The name of the colormap, a key of COLORMAP_LUTS.
+
+    Returns:
+    - bytes: The encoded PNG.
+    """
+    heatmap_image = Image.fromarray(quantize_scores(scores))
+    heatmap_image.putpalette(COLORMAP_LUTS[colormap].tobytes())
+
+    buffer = io.BytesIO()
+    heatmap_image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
 def dyadic_average_downsample_heatmap(float_matrix):
     """
     Downsample the heatmap by averaging the values in 2x2 blocks.
@@ -66,24 +94,295 @@ def dyadic_average_downsample_heatmap(float_matrix):
     return downsampled_matrix
 
 
+def to_heatmap_dtype(heatmap, dtype=None):
+    """
+    Convert a score grid to a storage dtype, quantizing the scores for uint8.
+
+    Parameters:
+    - heatmap (np.ndarray): The score grid, in any of HEATMAP_DTYPES.
+    - dtype (str): One of HEATMAP_DTYPES, None to keep the dtype of heatmap.
+
+    Returns:
+    - np.ndarray: The score grid in dtype.
+    """
+    if dtype is None or heatmap.dtype == np.dtype(dtype):
+        return heatmap
+    if dtype not in HEATMAP_DTYPES:
+        raise ValueError(f"Heatmap dtype must be one of {HEATMAP_DTYPES}, got {dtype}")
+
+    scores = upcast_heatmap(heatmap)
+    if dtype == "uint8":
+        return np.rint(np.clip(scores, 0, 1) * HEATMAP_UINT8_MAX).astype(np.uint8)
+    return scores.astype(dtype)
+
+
+def upcast_heatmap(heatmap):
+    """
+    Get the scores of a score grid stored in any of HEATMAP_DTYPES as floats.
+
+    Parameters:
+    - heatmap (np.ndarray): The score grid, or a single cell of it.
+
+    Returns:
+    - np.ndarray: The scores as float32, or as is if already float32 or float64.
+    """
+    if heatmap.dtype == np.uint8:
+        return heatmap.astype(np.float32) / np.float32(HEATMAP_UINT8_MAX)
+    if heatmap.dtype == np.float16:
+        return heatmap.astype(np.float32)
+    return heatmap
+
+
+def get_heatmap_tile_scores(score_grid, x, y, cells_per_tile, tile_size=512):
+    """
+    Get the per pixel scores of a heatmap tile from a grid of cell scores.
+
+    The tile at (x, y) covers the cells_per_tile x cells_per_tile block of cells starting
+    at score_grid[x * cells_per_tile, y * cells_per_tile], and each cell is upsampled to a
+    square of tile_size // cells_per_tile pixels. Cells past the edge of the grid score 0.
+
+    Parameters:
+    - score_grid (np.ndarray): The cell scores, indexed as score_grid[x, y].
+    - x (int): The x-coordinate of the tile.
+    - y (int): The y-coordinate of the tile.
+    - cells_per_tile (int): The number of cells along each side of the tile.
+    - tile_size (int): The size of the tile in pixels.
+
+    Returns:
+    - np.ndarray: The (tile_size, tile_size) scores, indexed as [row, col].
+    """
+    cell_size = tile_size // cells_per_tile
+
+    if cell_size == 0:
+        return np.zeros((tile_size, tile_size))
+
+    # Slice the cells of the tile and pad the ones past the edge of the slide with 0
+    cell_scores = np.zeros((cells_per_tile, cells_per_tile))
+    tile_cells = score_grid[
+        x * cells_per_tile : (x + 1) * cells_per_tile,
+        y * cells_per_tile : (y + 1) * cells_per_tile,
+    ]
+    cell_scores[: tile_cells.shape[0], : tile_cells.shape[1]] = upcast_heatmap(
+        tile_cells
+    )
+
+    # Upsample each cell to a cell_size x cell_size square in a single copy, transposed
+    # since the grid is indexed [x, y] and the tile [row, col]
+    upsampled_scores = np.broadcast_to(
+        cell_scores.T[:, None, :, None],
+        (cells_per_tile, cell_size, cells_per_tile, cell_size),
+    ).reshape(tile_size, tile_size)
+    return np.ascontiguousarray(upsampled_scores)
+
+
+def get_dz_tile_scores(dz_heatmap_dict, level, x, y, tile_size=512):
+    """
+    Get the per pixel scores of the heatmap tile at a DZ level and location.
+
+    Zoomed in tiles are cut from the level 18 score grid. Once a tile would span more
+    cells than it has pixels, the tile is cut from the coarsest pyramid level that still
+    has at most one cell per pixel, so every tile costs O(tile_size ** 2) at any zoom.
+
+    Parameters:
+    - dz_heatmap_dict (dict or LazyHeatmapPyramid): The score pyramid, mapping DZ levels 0 to 18 to score grids.
+    - level (int): The DZ level of the tile.
+    - x (int): The x-coordinate of the tile.
+    - y (int): The y-coordinate of the tile.
+    - tile_size (int): The size of the tile in pixels.
+
+    Returns:
+    - np.ndarray: The (tile_size, tile_size) scores, indexed as [row, col].
+    """
+    max_cells_per_tile_log2 = int(np.log2(tile_size))
+    score_level = min(18, level + max_cells_per_tile_log2)
+
+    return get_heatmap_tile_scores(
+        dz_heatmap_dict[score_level], x, y, 2 ** (score_level - level), tile_size
+    )
+
+
+def get_dz_tile_grid_shape(slide_width, slide_height, level, tile_size=512):
+    """
+    Get the number of tiles along x and y at a DZ level, where level 18 is full resolution.
+
+    Parameters:
+    - slide_width (int): The width of the slide at level 0.
+    - slide_height (int): The height of the slide at level 0.
+    - level (int): The DZ level.
+    - tile_size (int): The size of the tiles in pixels.
+
+    Returns:
+    - tuple: The (num_tiles_x, num_tiles_y) of the level.
+    """
+    downsample = 2 ** (18 - level)
+    level_width = -(-slide_width // downsample)
+    level_height = -(-slide_height // downsample)
+    return -(-level_width // tile_size), -(-level_height // tile_size)
+
+
+def get_dz_tile_size(slide_width, slide_height, level, x, y, tile_size=512):
+    """
+    Get the size of the DZ tile at a level and location, smaller than tile_size at the right and bottom edges.
+
+    Parameters:
+    - slide_width (int): The width of the slide at level 0.
+    - slide_height (int): The height of the slide at level 0.
+    - level (int): The DZ level.
+    - x (int): The x-coordinate of the tile.
+    - y (int): The y-coordinate of the tile.
+    - tile_size (int): The size of the tiles in pixels.
+
+    Returns:
+    - tuple: The (width, height) of the tile, 0 for tiles past the edge of the level.
+    """
+    downsample = 2 ** (18 - level)
+    level_width = -(-slide_width // downsample)
+    level_height = -(-slide_height // downsample)
+    return (
+        max(0, min(tile_size, level_width - x * tile_size)),
+        max(0, min(tile_size, level_height - y * tile_size)),
+    )
+
+
+class LazyHeatmapPyramid(Mapping):
+    """
+    The score pyramid of a heatmap, mapping DZ levels 0 to 18 to score grids, built on demand.
+
+    Level 18 is the heatmap itself. A coarser level is averaged down the first time it is
+    accessed and memoized, along with the levels in between. The averages are taken in
+    float from the nearest finer memoized level, or from the unquantized heatmap for
+    float16 and uint8 levels so their rounding does not compound from level to level, and
+    only the memoized result is stored in heatmap_dtype. With a max_cached_bytes, the
+    least recently used levels other than 18 are dropped once the memoized levels take
+    more than that, and are recomputed if they are needed again.
+    Levels given in stored_levels, like the memory mapped levels of a heatmap sidecar, are
+    returned as they are and never dropped.
+
+    === Attributes ===
+    - heatmap_dtype: the dtype the levels are stored in, one of HEATMAP_DTYPES
+    - max_cached_bytes: the most bytes the memoized levels other than 18 may take, None for no limit
+    - stored_levels: the precomputed levels, by DZ level
+    """
+
+    num_levels = 19
+
+    def __init__(
+        self, heatmap, heatmap_dtype=None, max_cached_bytes=None, stored_levels=None
+    ):
+        self.heatmap_dtype = heatmap_dtype or heatmap.dtype.name
+        self.max_cached_bytes = max_cached_bytes
+        self.stored_levels = stored_levels if stored_levels is not None else {}
+        self._heatmap = heatmap
+        self._base_level = to_heatmap_dtype(heatmap, self.heatmap_dtype)
+        # the memoized levels other than 18, and when each was last used
+        self._levels = {}
+        self._last_used = {}
+        self._use_counter = itertools.count()
+        # levels may be requested from several server threads at once, memo hits take
+        # no lock and only building a missing level is serialized
+        self._lock = threading.Lock()
+
+    def __getitem__(self, level):
+        if level == self.num_levels - 1:
+            return self._base_level
+        if level not in self:
+            raise KeyError(level)
+        if level in self.stored_levels:
+            return self.stored_levels[level]
+
+        score_grid = self._levels.get(level)
+        if score_grid is not None:
+            self._last_used[level] = next(self._use_counter)
+            return score_grid
+
+        with self._lock:
+            # another thread may have built the level while this one waited
+            score_grid = self._levels.get(level)
+            if score_grid is None:
+                score_grid = self._build_level(level)
+            self._last_used[level] = next(self._use_counter)
+            self._drop_least_recently_used(keep_level=level)
+            return score_grid
+
+    def _build_level(self, level):
+        """Average a missing level down, memoizing it and the levels in between."""
+        if self.heatmap_dtype in ["float64", "float32"]:
+            # average down from the nearest finer level that is still memoized
+            finer_level = level + 1
+            while finer_level < self.num_levels - 1 and finer_level not in self._levels:
+                finer_level += 1
+            current_heatmap = upcast_heatmap(
+                self._levels.get(finer_level, self._base_level)
+            )
+        else:
+            finer_level = self.num_levels - 1
+            current_heatmap = upcast_heatmap(self._heatmap)
+
+        for coarser_level in range(finer_level - 1, level - 1, -1):
+            current_heatmap = dyadic_average_downsample_heatmap(current_heatmap)
+            self._levels[coarser_level] = to_heatmap_dtype(
+                current_heatmap, self.heatmap_dtype
+            )
+        return self._levels[level]
+
+    def __contains__(self, level):
+        return isinstance(level, (int, np.integer)) and 0 <= level < self.num_levels
+
+    def __iter__(self):
+        return iter(range(self.num_levels))
+
+    def __len__(self):
+        return self.num_levels
+
+    @property
+    def cached_bytes(self):
+        """The bytes taken by the memoized levels other than 18."""
+        return sum(score_grid.nbytes for score_grid in self._levels.values())
+
+    def _drop_least_recently_used(self, keep_level):
+        """Drop the least recently used levels until the memoized levels fit in max_cached_bytes."""
+        if self.max_cached_bytes is None:
+            return
+
+        cached_bytes = self.cached_bytes
+        for level in sorted(self._levels, key=lambda l: self._last_used.get(l, -1)):
+            if cached_bytes <= self.max_cached_bytes:
+                break
+            if level == keep_level:
+                continue
+            cached_bytes -= self._levels.pop(level).nbytes
+
+
 class HeatMapTileLoader:
     """ """
 
-    def __init__(self, np_heatmap, tile_size=512):
+    def __init__(
+        self,
+        np_heatmap,
+        tile_size=512,
+        heatmap_dtype=None,
+        max_cached_bytes=None,
+        stored_levels=None,
+    ):
         self.tile_size = tile_size
         # shape of the heatmap should be slide_width_level_0 // 512, slide_height_level_0 // 512, we start by initializing it to zeros numpy array
         self.heatmap = np_heatmap
-        self.dz_heatmap_dict = {}
+        # the dtype the pyramid levels are kept in, None for the dtype of np_heatmap
+        self.heatmap_dtype = heatmap_dtype
+        # the most bytes the memoized coarser levels may take, None for no limit
+        self.max_cached_bytes = max_cached_bytes
+        # precomputed pyramid levels, e.g. memory mapped from a heatmap sidecar
+        self.stored_levels = stored_levels
+        self.compute_heatmap()
 
     def compute_heatmap(self):
-
-        self.dz_heatmap_dict[18] = self.heatmap
-
-        current_heatmap = self.heatmap
-
-        for level in range(18 - 1, -1, -1):
-            current_heatmap = dyadic_average_downsample_heatmap(current_heatmap)
-            self.dz_heatmap_dict[level] = current_heatmap
+        # the levels are only averaged when first used, so this returns at once
+        self.dz_heatmap_dict = LazyHeatmapPyramid(
+            self.heatmap,
+            heatmap_dtype=self.heatmap_dtype,
+            max_cached_bytes=self.max_cached_bytes,
+            stored_levels=self.stored_levels,
+        )
 
     def get_heatmap_values(self, level, x, y):
         """
@@ -100,7 +399,7 @@ class HeatMapTileLoader:
 
         try:
             return float(
-                self.dz_heatmap_dict[level][x, y]
+                upcast_heatmap(self.dz_heatmap_dict[level][x, y])
             )  # if index out of bounds, return 0
         except IndexError:
             return float(0)
@@ -118,28 +417,9 @@ class HeatMapTileLoader:
         - np.ndarray: The heatmap overlay as a NumPy array.
         """
 
-        openslide_level = 18 - level
-        heatmap_grid_size = 512 // (2 ** (openslide_level))
-
-        heatmap_overlay_score = np.zeros((512, 512))
-
-        if openslide_level <= 7:
-            for i in range(2 ** (openslide_level)):
-                for j in range(2 ** (openslide_level)):
-                    # heatmap_overlay_score[j*heatmap_grid_size:(j+1)*heatmap_grid_size, i*heatmap_grid_size:(i+1)*heatmap_grid_size] = self.get_gaussian_heatmap_values(x*(2**(openslide_level)) + i, y*(2**(openslide_level)) + j)
-                    heatmap_overlay_score[
-                        j * heatmap_grid_size : (j + 1) * heatmap_grid_size,
-                        i * heatmap_grid_size : (i + 1) * heatmap_grid_size,
-                    ] = self.get_heatmap_values(
-                        18,
-                        x * 2 ** (openslide_level) + i,
-                        y * 2 ** (openslide_level) + j,
-                    )
-
-            return generate_red_green_heatmap(heatmap_overlay_score)
+        heatmap_overlay_score = get_dz_tile_scores(self.dz_heatmap_dict, level, x, y)
 
-        else:
-            return generate_red_green_heatmap(heatmap_overlay_score)
+        return generate_red_green_heatmap(heatmap_overlay_score)
 
     def save_heatmap_to_h5(self, heatmap_h5_save_path):
         # save the self.dz_heatmap_dict[18] to the h5 file with a key "heatmap"
@@ -150,17 +430,36 @@ class HeatMapTileLoader:
         print(f"Saved heatmap to {heatmap_h5_save_path}")
 
 
+def blend_overlay(region, heatmap, alpha=0.5):
+    """
+    Blend a heatmap over a region as (1 - alpha) * region + alpha * heatmap.
+
+    The blend is done in uint16 fixed point with alpha quantized to 1/256 steps, which
+    matches the float32 blend to within 1 and allocates only two uint16 temporaries
+    instead of the float32 copies of both tiles.
+
+    Parameters:
+    - region (np.ndarray): The (height, width, 3) uint8 region.
+    - heatmap (np.ndarray): The uint8 heatmap, cropped to the size of the region.
+    - alpha (float): The weight of the heatmap, clamped to [0, 1].
+
+    Returns:
+    - np.ndarray: The (height, width, 3) uint8 overlay.
+    """
+    heatmap = heatmap[: region.shape[0], : region.shape[1]]
+    heatmap_weight = int(round(min(max(alpha, 0.0), 1.0) * 256))
+
+    overlay = region.astype(np.uint16)
+    overlay *= 256 - heatmap_weight
+    overlay += np.multiply(heatmap, heatmap_weight, dtype=np.uint16)
+    overlay >>= 8
+    return overlay.astype(np.uint8)
+
+
 def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
     heatmap_image = np.array(heatmap_image.convert("RGB"))
     if region.shape[2] != 3:
         raise ValueError("Region image must be in RGB format with 3 channels")
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-
-    # crop the heatmap image to the same size as the region
-    heatmap_image = heatmap_image[: region.shape[0], : region.shape[1]]
 
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    overlay_image_np = np.clip(overlay_image_np, 0, 1)
-    overlay_image_np = (overlay_image_np * 255).astype(np.uint8)
+    overlay_image_np = blend_overlay(region, heatmap_image, alpha=alpha)
     return Image.fromarray(overlay_image_np)
@@ -1,12 +1,13 @@
 import io
 import os
 import h5py
-import base64
 import numpy as np
 from PIL import Image
+from tile_h5 import read_tile_bytes
 from flask import Flask, send_file, abort, Response, request
 from flask_cors import CORS
-from read_heatmap import HeatMapTileLoader, get_heatmap_overlay
+from read_heatmap import get_heatmap_overlay
+from heatmap_sidecar import load_heatmap_tile_loader
 
 app = Flask(__name__)
 CORS(app)
@@ -20,24 +21,16 @@ slide_h5_path = os.path.join(S3_MOUNT_PATH, slide_name + ".h5")
 heatmap_h5_path = os.path.join(S3_MOUNT_PATH, slide_name + "_heatmap.h5")
 
 
-# Load heatmap data with dimension check
-with h5py.File(heatmap_h5_path, "r") as f:
-    heatmap_dataset = f["heatmap"]
-    print(f"Heatmap dataset shape: {heatmap_dataset.shape}")
-
-    # make sure heatmap dataset is a numpy array
-    heatmap = np.array(heatmap_dataset) 
-    # Create heatmap tile loader
-    heatmap_tile_loader = HeatMapTileLoader(np_heatmap=heatmap)
-    heatmap_tile_loader.compute_heatmap()
+# Create heatmap tile loader
+heatmap_tile_loader = load_heatmap_tile_loader(heatmap_h5_path)
+print(f"Heatmap dataset shape: {heatmap_tile_loader.heatmap.shape}")
 
 
 def retrieve_tile_h5(h5_path, level, row, col):
     """Retrieve the tile from an HDF5 file given level, row, and col."""
     with h5py.File(h5_path, "r") as f:
         try:
-            jpeg_string = f[str(level)][row, col]
-            jpeg_string = base64.b64decode(jpeg_string)
+            jpeg_string = read_tile_bytes(f, level, row, col)
             image = Image.open(io.BytesIO(jpeg_string))
             image.load()  # Ensure the image is loaded fully
             return image
@@ -10,12 +10,13 @@ from flask import (
 )
 from flask_cors import CORS
 from PIL import Image
+from tile_h5 import read_tile_bytes
 import h5py
 import io
 import numpy as np
 import os
-import base64
-from read_heatmap import HeatMapTileLoader
+from read_heatmap import blend_overlay
+from heatmap_sidecar import load_heatmap_tile_loader
 
 app = Flask(__name__)
 CORS(app)
@@ -49,19 +50,14 @@ with h5py.File(slide_h5_path, "r") as f:
 alpha = DEFAULT_ALPHA
 
 # Initialize heatmap on startup
-with h5py.File(heatmap_h5_path, "r") as f:
-    heatmap_dataset = f["heatmap"]
-    heatmap = np.array(heatmap_dataset)
-    heatmap_tile_maker = HeatMapTileLoader(np_heatmap=heatmap, tile_size=TILE_SIZE)
-    heatmap_tile_maker.compute_heatmap()
+heatmap_tile_maker = load_heatmap_tile_loader(heatmap_h5_path, tile_size=TILE_SIZE)
 
 
 def retrieve_tile_h5(h5_path, level, row, col):
     """Retrieve tile from an HDF5 file."""
     with h5py.File(h5_path, "r") as f:
         try:
-            jpeg_string = f[str(level)][row, col]
-            jpeg_string = base64.b64decode(jpeg_string)
+            jpeg_string = read_tile_bytes(f, level, row, col)
             image = Image.open(io.BytesIO(jpeg_string))
             image.load()
             return image
@@ -76,16 +72,7 @@ def get_heatmap_overlay(region, heatmap_image, alpha=0.5):
     if region.shape[2] != 3:
         raise ValueError("Region image must be in RGB format with 3 channels")
 
-    region = region.astype(np.float32) / 255.0
-    heatmap_image = heatmap_image.astype(np.float32) / 255.0
-
-    # make sure the heatmap image is the same size as the region
-    heatmap_image = heatmap_image[: region.shape[0], : region.shape[1]]
-
-    overlay_image_np = (1 - alpha) * region + alpha * heatmap_image
-    overlay_image_np = np.clip(overlay_image_np, 0, 1)
-    overlay_image_np = (overlay_image_np * 255).astype(np.uint8)
-    return overlay_image_np
+    return blend_overlay(region, heatmap_image, alpha=alpha)
 
 
 @app.route("/tile/<int:level>/<int:x>/<int:y>/", methods=["GET"])
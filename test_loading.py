@@ -1,9 +1,9 @@
 import io
 import os
 import h5py
-import base64
 import numpy as np
 from PIL import Image
+from tile_h5 import read_tile_bytes
 import random
 from read_heatmap import HeatMapTileLoader, get_heatmap_overlay
 from tqdm import tqdm
@@ -43,8 +43,7 @@ def retrieve_tile_h5(h5_path, level, row, col):
     """Retrieve the tile from an HDF5 file given level, row, and col."""
     with h5py.File(h5_path, "r") as f:
         try:
-            jpeg_string = f[str(level)][row, col]
-            jpeg_string = base64.b64decode(jpeg_string)
+            jpeg_string = read_tile_bytes(f, level, row, col)
             image = Image.open(io.BytesIO(jpeg_string))
             image.load()  # Ensure the image is loaded fully
             return image
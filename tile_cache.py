@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024  # 512 MiB
+
+
+class TileCache:
+    """
+    A thread-safe LRU cache of encoded tiles, capped by the total size of the stored bytes.
+
+    === Attributes ===
+    - max_bytes: the maximum total number of bytes stored
+    - current_bytes: the total number of bytes currently stored
+    - num_hits: the number of get calls that found the key
+    - num_misses: the number of get calls that did not find the key
+    - num_evictions: the number of entries dropped to stay under max_bytes
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> bytes, least recently used first
+
+    def get(self, key):
+        """Return the bytes stored for key, or None if the key is not cached."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.num_misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.num_hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entries if needed."""
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old_value = self._entries.pop(key, None)
+            if old_value is not None:
+                self.current_bytes -= len(old_value)
+
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                _, evicted_value = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted_value)
+                self.num_evictions += 1
+
+            self._entries[key] = value
+            self.current_bytes += size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        """Drop every entry, the counters are kept."""
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        """Return the cache counters as a dictionary."""
+        with self._lock:
+            num_lookups = self.num_hits + self.num_misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.num_hits,
+                "misses": self.num_misses,
+                "evictions": self.num_evictions,
+                "hit_rate": self.num_hits / num_lookups if num_lookups else 0.0,
+            }
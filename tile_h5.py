@@ -0,0 +1,113 @@
+import base64
+import h5py
+import numpy as np
+
+# v1 stores every tile as a base64 encoded JPEG string, v2 stores the encoded bytes as
+# variable length uint8 arrays so they can be read without decoding
+TILE_FORMAT_VERSION_ATTR = "tile_format_version"
+TILE_FORMAT_V1 = 1
+TILE_FORMAT_V2 = 2
+TILE_BYTES_DTYPE = h5py.vlen_dtype(np.uint8)
+
+
+def is_level_key(key):
+    """Return whether an HDF5 key names a tile pyramid level, e.g. "0" to "18"."""
+    return key.isdigit()
+
+
+def is_raw_tile_dataset(dataset):
+    """Return whether a level dataset stores raw tile bytes (v2) rather than base64 strings (v1)."""
+    return h5py.check_vlen_dtype(dataset.dtype) == np.uint8
+
+
+def get_tile_format_version(f):
+    """
+    Get the tile format version of an open tile pyramid HDF5 file.
+
+    Parameters:
+    - f (h5py.File): The open HDF5 file.
+
+    Returns:
+    - int: TILE_FORMAT_V1 or TILE_FORMAT_V2.
+    """
+    if TILE_FORMAT_VERSION_ATTR in f.attrs:
+        return int(f.attrs[TILE_FORMAT_VERSION_ATTR])
+
+    for key in f.keys():
+        if is_level_key(key):
+            return TILE_FORMAT_V2 if is_raw_tile_dataset(f[key]) else TILE_FORMAT_V1
+
+    return TILE_FORMAT_V1
+
+
+def decode_tile_value(value):
+    """Turn a value read from a v1 or v2 level dataset into the encoded tile bytes."""
+    if isinstance(value, np.ndarray):
+        return value.tobytes()
+    return base64.b64decode(value)
+
+
+def read_tile_bytes(f, level, row, col):
+    """
+    Read the encoded tile bytes at a level, row and column, for either tile format.
+
+    Parameters:
+    - f (h5py.File): The open HDF5 file.
+    - level (int): The DZ level of the tile.
+    - row (int): The row of the tile.
+    - col (int): The column of the tile.
+
+    Returns:
+    - bytes: The encoded (JPEG) tile.
+    """
+    return decode_tile_value(f[str(level)][row, col])
+
+
+def get_tile_read_order(f, level, row, col):
+    """
+    Get the sort key that orders tile reads by level and by HDF5 chunk within a level.
+
+    Tiles of a contiguous level dataset are ordered by row and column, i.e. by file offset.
+    """
+    chunks = f[str(level)].chunks or (1, 1)
+    return (level, row // chunks[0], col // chunks[1], row, col)
+
+
+def read_many_tile_bytes(f, tiles):
+    """
+    Read the encoded bytes of many tiles, for either tile format.
+
+    The tiles are read sorted by level and chunk, so the tiles sharing a chunk are read one
+    after the other and all but the first are served by the HDF5 chunk cache.
+
+    Parameters:
+    - f (h5py.File): The open HDF5 file.
+    - tiles (list): The (level, row, col) of every tile.
+
+    Returns:
+    - dict: The encoded tile bytes by (level, row, col), without the tiles that are not in the file.
+    """
+    existing_tiles = []
+    for level, row, col in set(tiles):
+        if str(level) not in f:
+            continue
+        num_rows, num_cols = f[str(level)].shape
+        if 0 <= row < num_rows and 0 <= col < num_cols:
+            existing_tiles.append((level, row, col))
+
+    existing_tiles.sort(key=lambda tile: get_tile_read_order(f, *tile))
+    return {
+        (level, row, col): read_tile_bytes(f, level, row, col)
+        for level, row, col in existing_tiles
+    }
+
+
+def create_tile_dataset(f, level, shape):
+    """Create an empty v2 level dataset of the given (rows, cols) shape."""
+    f.attrs[TILE_FORMAT_VERSION_ATTR] = TILE_FORMAT_V2
+    return f.create_dataset(str(level), shape=shape, dtype=TILE_BYTES_DTYPE)
+
+
+def encode_tile_value(tile_bytes):
+    """Turn encoded tile bytes into a value that can be stored in a v2 level dataset."""
+    return np.frombuffer(tile_bytes, dtype=np.uint8)
@@ -0,0 +1,193 @@
+import threading
+from collections import OrderedDict, deque
+
+DEFAULT_MAX_QUEUED = 256  # Oldest queued prefetches are dropped beyond this
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_RING_RADIUS = 1  # The ring of same level tiles prefetched around a request
+DEFAULT_CANCEL_DISTANCE = 4  # In tiles, further queued prefetches are cancelled
+MAX_TRACKED_PREFETCHES = 4096  # Number of prefetched, and of failed, keys remembered
+
+
+def remember_key(keys, key):
+    """Add a key to an OrderedDict of keys, forgetting the oldest beyond MAX_TRACKED_PREFETCHES."""
+    keys[key] = True
+    while len(keys) > MAX_TRACKED_PREFETCHES:
+        keys.popitem(last=False)
+
+
+class TilePrefetcher:
+    """
+    Warm a tile cache with the neighbourhood of the tiles that are requested.
+
+    After a tile is served, the tiles around it at the same level, its parent and its
+    children are queued and built by background workers into the tile cache, so the tiles
+    a pan or zoom asks for next are often cached already. Cache keys are tuples starting
+    with (slide, level, x, y), the rest of the key (e.g. the alpha and colormap) is kept
+    for the neighbours. The queue is bounded and served newest first, and a queued tile
+    is cancelled once the viewer has moved more than cancel_distance tiles or a level away
+    from it.
+
+    === Attributes ===
+    - tile_cache: the TileCache the tiles are built into
+    - build_tile: the function building the tile bytes of a cache key, returning None if the tile can not be served
+    - max_queued: the maximum number of queued prefetches
+    - ring_radius: the radius in tiles of the same level ring prefetched around a request
+    - cancel_distance: the distance in tiles from the latest request beyond which queued prefetches are cancelled
+    - num_queued: the number of prefetches queued
+    - num_prefetched: the number of tiles built into the tile cache
+    - num_cancelled: the number of queued prefetches cancelled because the viewer moved away
+    - num_dropped: the number of queued prefetches dropped because the queue was full
+    - num_failed: the number of prefetches that did not produce a tile
+    - num_hits: the number of requests served from the tile cache by a prefetched tile
+    """
+
+    def __init__(
+        self,
+        tile_cache,
+        build_tile,
+        max_queued=DEFAULT_MAX_QUEUED,
+        num_workers=DEFAULT_NUM_WORKERS,
+        ring_radius=DEFAULT_RING_RADIUS,
+        cancel_distance=DEFAULT_CANCEL_DISTANCE,
+    ):
+        self.tile_cache = tile_cache
+        self.build_tile = build_tile
+        self.max_queued = max_queued
+        self.ring_radius = ring_radius
+        self.cancel_distance = cancel_distance
+
+        self.num_queued = 0
+        self.num_prefetched = 0
+        self.num_cancelled = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.num_hits = 0
+
+        self._condition = threading.Condition()
+        self._queue = deque()  # cache keys, served from the right
+        self._queued_keys = set()
+        self._latest_requests = {}  # (slide, *rest of the key) -> (level, x, y)
+        self._prefetched_keys = OrderedDict()  # prefetched keys not requested yet
+        self._failed_keys = OrderedDict()  # e.g. tiles past the edge of the slide
+
+        for _ in range(num_workers):
+            threading.Thread(target=self._run_worker, daemon=True).start()
+
+    def on_tile_request(self, cache_key, cache_hit):
+        """
+        Record a tile request and queue the prefetches of its neighbourhood.
+
+        Parameters:
+        - cache_key (tuple): The cache key of the requested tile, starting with (slide, level, x, y).
+        - cache_hit (bool): Whether the tile was served from the tile cache.
+        """
+        slide, level, x, y, *rest = cache_key
+        neighbour_keys = [
+            (slide, *tile, *rest) for tile in self.get_neighbour_tiles(level, x, y)
+        ]
+
+        with self._condition:
+            if self._prefetched_keys.pop(cache_key, None) is not None and cache_hit:
+                self.num_hits += 1
+            self._latest_requests[(slide, *rest)] = (level, x, y)
+
+            # queued last is served first, so the closest neighbours are queued last
+            for neighbour_key in reversed(neighbour_keys):
+                if neighbour_key in self._queued_keys:
+                    continue
+                if neighbour_key in self._failed_keys:
+                    continue
+                if neighbour_key in self.tile_cache:
+                    continue
+                if len(self._queue) >= self.max_queued:
+                    self._queued_keys.discard(self._queue.popleft())
+                    self.num_dropped += 1
+                self._queue.append(neighbour_key)
+                self._queued_keys.add(neighbour_key)
+                self.num_queued += 1
+            self._condition.notify_all()
+
+    def get_neighbour_tiles(self, level, x, y):
+        """
+        Get the (level, x, y) of the tiles to prefetch around a tile, closest first.
+
+        These are the ring at the same level, then the parent and the four children.
+        """
+        ring = [
+            (level, x + dx, y + dy)
+            for dx in range(-self.ring_radius, self.ring_radius + 1)
+            for dy in range(-self.ring_radius, self.ring_radius + 1)
+            if (dx, dy) != (0, 0)
+        ]
+        ring.sort(key=lambda tile: max(abs(tile[1] - x), abs(tile[2] - y)))
+        parent = [(level - 1, x // 2, y // 2)] if level > 0 else []
+        children = [
+            (level + 1, 2 * x + dx, 2 * y + dy) for dx in range(2) for dy in range(2)
+        ]
+        return [
+            tile for tile in ring + parent + children if tile[1] >= 0 and tile[2] >= 0
+        ]
+
+    def is_stale(self, cache_key):
+        """Return whether the viewer has moved away from a queued tile since it was queued."""
+        slide, level, x, y, *rest = cache_key
+        latest_level, latest_x, latest_y = self._latest_requests[(slide, *rest)]
+        if abs(level - latest_level) > 1:
+            return True
+
+        # compare the tile centers in tiles of the latest level
+        scale = 2.0 ** (latest_level - level)
+        distance = max(
+            abs((x + 0.5) * scale - (latest_x + 0.5)),
+            abs((y + 0.5) * scale - (latest_y + 0.5)),
+        )
+        return distance > self.cancel_distance
+
+    def _run_worker(self):
+        """Build the queued tiles into the tile cache, newest first."""
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                cache_key = self._queue.pop()
+                self._queued_keys.discard(cache_key)
+                if self.is_stale(cache_key):
+                    self.num_cancelled += 1
+                    continue
+
+            if cache_key in self.tile_cache:
+                continue
+
+            try:
+                tile_bytes = self.build_tile(cache_key)
+            except Exception as e:
+                print(f"Error prefetching tile {cache_key}: {e}")
+                tile_bytes = None
+
+            if tile_bytes is None:
+                with self._condition:
+                    self.num_failed += 1
+                    # tiles that can not be served are not prefetched again
+                    remember_key(self._failed_keys, cache_key)
+                continue
+
+            self.tile_cache.put(cache_key, tile_bytes)
+            with self._condition:
+                self.num_prefetched += 1
+                remember_key(self._prefetched_keys, cache_key)
+
+    def stats(self):
+        """Return the prefetch counters as a dictionary."""
+        with self._condition:
+            return {
+                "queued": self.num_queued,
+                "queue_length": len(self._queue),
+                "prefetched": self.num_prefetched,
+                "cancelled": self.num_cancelled,
+                "dropped": self.num_dropped,
+                "failed": self.num_failed,
+                "hits": self.num_hits,
+                "hit_rate": (
+                    self.num_hits / self.num_prefetched if self.num_prefetched else 0.0
+                ),
+            }